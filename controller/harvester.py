@@ -0,0 +1,165 @@
+# -*- encoding: utf-8 -*-
+"""Bulk harvesting of metadata from the pdok result listings.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from util.cache import cached_html
+import re
+import threading
+
+
+# Result listing of all documents of a type in a period, paged by offset
+BASEURL_META_LISTING = "http://pdok.bundestag.de/treffer.php?q=&wp={0}&dart={1}&start={2}"
+# Number of hits on a listing page
+LISTING_PAGE_SIZE = 100
+# Minimum number of per-document lookups after which the whole listing of the
+# period is harvested (more for periods with more listing pages)
+HARVEST_THRESHOLD = 20
+# Seconds after which a cached listing page is fetched again (shorter than for
+# single documents, as new documents show up on the listings)
+LISTING_CACHE_TTL = 24 * 60 * 60
+
+# Every hit in a listing contains the document number in a <strong> tag,
+# followed by the date and (for Drucksachen) the document type
+DOCNO_PAT = re.compile('<strong>(\d{2}/\d+)</strong>')
+STRONG_PAT = re.compile('<strong>(.+?)</strong>')
+TITLE_PAT = re.compile('<a.*?>(.+?)</a>')
+URHEBER_PAT = re.compile('Urheber: <strong>(.+?)</strong>')
+AUTOREN_PAT = re.compile('Autoren: (.+?)</div>')
+
+
+class MetadataHarvester(object):
+    """Lazily harvested metadata of all documents of a period and type.
+
+    The first few lookups return None, so the caller uses the per-document
+    lookup.  Once there have been as many lookups as the listing has pages
+    (but at least HARVEST_THRESHOLD), the complete listing of the period is
+    harvested (once), and all further lookups are answered from it.  This
+    way, runs picking up a few new documents never fetch the whole listing,
+    and larger runs spend at most twice the requests of the better choice.
+    Documents missing from the listing still return None, so the caller can
+    fall back to the per-document lookup.
+
+    While the listing is being harvested, the other lookups return None, so
+    the other workers carry on with per-document lookups.
+    """
+
+    def __init__(self, period_no, doctype, size=0):
+        """Create a new harvester.
+
+        Arguments:
+        period_no -- The formatted number of the period (e.g. 06)
+        doctype   -- Drucksache or Plenarprotokoll
+        size      -- the expected number of documents in the listing (e.g.
+                     the highest document number), or 0 if unknown
+        """
+        self.period_no = period_no
+        self.doctype = doctype
+        self.threshold = max(HARVEST_THRESHOLD, size // LISTING_PAGE_SIZE)
+        self.records = None
+        self.lookups = 0
+        self.harvesting = False
+        self._lock = threading.Lock()
+
+    def lookup(self, docno):
+        """Get the harvested metadata of a document.
+
+        Returns a tuple (title, date, doctype, urheber, autor), or None if
+        the document was not harvested (yet).  doctype, urheber and autor
+        may be None.
+        """
+        with self._lock:
+            self.lookups += 1
+            harvest = (self.records is None and not self.harvesting and
+                       self.lookups > self.threshold)
+            if harvest:
+                self.harvesting = True
+        if harvest:
+            try:
+                records = harvest_listing(self.period_no, self.doctype)
+            finally:
+                # On failure, the next lookup tries again
+                with self._lock:
+                    self.harvesting = False
+            self.records = records
+        records = self.records
+        if records is None:
+            return None
+        return records.get(docno)
+
+
+def harvest_listing(period_no, doctype):
+    """Harvest the metadata of all documents of a period and type.
+
+    Arguments:
+    period_no -- The formatted number of the period (e.g. 06)
+    doctype   -- Drucksache or Plenarprotokoll
+
+    Returns a dict mapping document numbers to tuples of
+    (title, date, doctype, urheber, autor).
+    """
+    print "INFO: Harvesting", doctype, "metadata for period", period_no
+    records = {}
+    offset = 0
+    while True:
+        html = cached_html(BASEURL_META_LISTING.format(int(period_no), doctype, offset),
+                           LISTING_CACHE_TTL)
+        if html is None:
+            break
+        page = parse_listing(html)
+        new = [hit for hit in page if hit[0] not in records]
+        for hit in new:
+            records[hit[0]] = hit[1:]
+        # Stop at the first page without new hits (pdok repeats the last
+        # page for offsets past the end)
+        if len(new) == 0:
+            break
+        offset += LISTING_PAGE_SIZE
+    print "INFO: Harvested metadata for", len(records), "documents"
+    return records
+
+
+def parse_listing(html):
+    """Parse all hits on a pdok result listing page.
+
+    Arguments:
+    html -- the HTML of the listing page
+
+    Returns a list of tuples (docno, title, date, doctype, urheber, autor),
+    where doctype, urheber and autor may be None.  Hits without title or
+    date are left out.
+    """
+    hits = []
+    matches = list(DOCNO_PAT.finditer(html))
+    for i, match in enumerate(matches):
+        # The title precedes the document number, the other metadata follows
+        # it, up to the start of the next hit
+        before = html[matches[i - 1].end() if i > 0 else 0:match.start()]
+        after = html[match.end():matches[i + 1].start() if i + 1 < len(matches) else len(html)]
+
+        titles = TITLE_PAT.findall(before)
+        meta = STRONG_PAT.findall(after)
+        if len(titles) < 1 or len(meta) < 1:
+            continue
+
+        urheber = URHEBER_PAT.findall(after)
+        autoren = AUTOREN_PAT.findall(after)
+        hits.append((match.group(1), titles[-1], meta[0],
+                     meta[1] if len(meta) > 1 else None,
+                     urheber[0] if len(urheber) > 0 else None,
+                     autoren[0] if len(autoren) > 0 else None))
+    return hits
@@ -0,0 +1,113 @@
+# -*- encoding: utf-8 -*-
+"""Revalidate already mirrored documents against the server.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from util.util import fetch_if_changed
+from util import manifest
+from util.convert import FAILED_SUFFIX
+from models.database import Wahlperiode, Plenarprotokoll, Drucksache, write_transaction
+from models.database import UPLOAD_DONE, UPLOAD_FAILED, add_upload_jobs
+from controller.uploader import archive_identifier
+from multiprocessing.pool import ThreadPool
+import os
+
+
+REFRESH_WORKERS = 6
+
+
+def refresh_period(period_no_numeric):
+    """Check all documents of a period for new versions on the server.
+
+    Arguments:
+    period_no_numeric -- The number of the period.
+    """
+    period = Wahlperiode.get(period_no='%02d' % period_no_numeric)
+    print "INFO: Refreshing Plenarprotokolle for period", period.period_no
+    refresh_documents(Plenarprotokoll, period)
+    print "INFO: Refreshing Drucksachen for period", period.period_no
+    refresh_documents(Drucksache, period)
+
+
+def refresh_documents(model, period):
+    """Check the documents of a period and type for new versions.
+
+    Unchanged documents cost a single conditional request.  For changed
+    documents, the new version is downloaded, and the text conversion and the
+    archive.org upload are invalidated, so they are redone on the next run
+    (the period is no longer marked as uploaded, so the uploader picks it up
+    again).  Their upload job is added or reset to pending, so the uploader
+    does not take the outdated archive item for the new version.
+
+    Arguments:
+    model  -- the document model (Drucksache or Plenarprotokoll)
+    period -- a models.database.Wahlperiode object
+    """
+    pool = ThreadPool(processes=REFRESH_WORKERS)
+    checked = 0
+    changed = 0
+    documents = _documents(model, period)
+    for document, result in pool.imap_unordered(_refresh_document, documents):
+        checked += 1
+        was_changed, entry = result
+        if entry is None:
+            continue
+
+        document.etag = entry.etag
+        document.last_modified = entry.last_modified
+        document.content_length = entry.size
+        document.sha256 = entry.sha256
+        document.md5 = entry.md5
+        if was_changed:
+            print "INFO: New version of", document.docno, "downloaded"
+            changed += 1
+            document.archive_ident = None
+            document.duplicate_of = manifest.original(document.path)
+            for suffix in (".txt", FAILED_SUFFIX):
+                if os.path.isfile(document.path[:-4] + suffix):
+                    os.remove(document.path[:-4] + suffix)
+        with write_transaction():
+            document.save()
+            if was_changed:
+                add_upload_jobs([dict(identifier=archive_identifier(model, document.docno),
+                                      period=period.dbid, doctype=model.__name__,
+                                      document=document.dbid)],
+                                states=(UPLOAD_DONE, UPLOAD_FAILED))
+            if was_changed and period.period_uploaded:
+                period.period_uploaded = False
+                period.save()
+    pool.close()
+    pool.join()
+    print "INFO: Checked", checked, "documents,", changed, "changed"
+
+
+def _documents(model, period):
+    """Generate the documents of a period and type.
+
+    The pool iterates over its tasks in a thread of its own.  A query would
+    be executed in the calling thread, and SQLite cursors cannot be used in
+    another thread, so the query is only run once the pool asks for the
+    first document.
+    """
+    for document in model.select().where(model.period == period).iterator():
+        yield document
+
+
+def _refresh_document(document):
+    """Helper function to refresh a document in a worker thread."""
+    return (document, fetch_if_changed(document.source, document.path,
+                                       document.etag, document.last_modified))
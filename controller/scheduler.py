@@ -0,0 +1,70 @@
+# -*- encoding: utf-8 -*-
+"""Scheduler running the scrapes and uploads of several periods at once.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from controller import scraper, uploader
+from util.pipeline import Pipeline, Stage
+
+
+# Number of periods scraped at the same time.  The network connections,
+# pdftotext processes and database writes are limited globally (see
+# util.util.set_host_limit, util.convert.PROCESS_LIMIT and
+# models.database.write_transaction), so this mostly overlaps the probing
+# and metadata lookups of the periods.
+PERIOD_WORKERS = 3
+# Number of periods uploaded at the same time
+UPLOAD_WORKERS = 1
+
+
+def run_periods(periods, max_period):
+    """Scrape and upload several periods concurrently.
+
+    The open period is started first, the others follow in ascending order.
+    Every period is uploaded as soon as its scrape has finished, while the
+    other periods are still being scraped.
+
+    Arguments:
+    periods    -- the numbers of the periods to process
+    max_period -- the number of the current (open) period
+    """
+    pipeline = Pipeline()
+    scrape = pipeline.add(Stage("scrape", lambda period_no_numeric: _scrape(period_no_numeric, max_period),
+                                workers=PERIOD_WORKERS))
+    pipeline.add(Stage("upload", _upload, workers=UPLOAD_WORKERS), after=scrape)
+    pipeline.start()
+    for period_no_numeric in prioritize(periods, max_period):
+        pipeline.feed(period_no_numeric)
+    pipeline.close()
+
+
+def prioritize(periods, max_period):
+    """Sort periods by priority: the open period first, then ascending."""
+    return sorted(set(periods), key=lambda period_no_numeric: (period_no_numeric != max_period, period_no_numeric))
+
+
+def _scrape(period_no_numeric, max_period):
+    """Scrape a period, passing on its number for the upload."""
+    scraper.scrape_period(period_no_numeric, max_period)
+    return period_no_numeric
+
+
+def _upload(period_no_numeric):
+    """Upload a scraped period (None if the scrape failed)."""
+    if period_no_numeric is None:
+        return
+    uploader.upload_legislaturperiode(period_no_numeric)
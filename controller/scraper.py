@@ -17,17 +17,75 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from util.util import _download_tuple, get_html, pdf_to_text
-from models.database import Wahlperiode, Plenarprotokoll, Drucksache
-from multiprocessing.pool import ThreadPool, Process
-from peewee import DoesNotExist
+from util.util import NotPdf, RequestFailed, backoff_delay, configure_session, download, hedge_stats, host_limit
+from util.util import set_host_limit, set_mirrors, url_exists
+from util.cache import cached_html, invalidate
+from util.convert import Throughput, convert_pdf, pdftotext_available
+from util.dedup import deduplicate
+from util.fulltext import Indexer
+from util.pipeline import Pipeline, Stage
+from util import manifest
+from controller.harvester import MetadataHarvester
+from models.database import BATCH_SIZE, Wahlperiode, Plenarprotokoll, Drucksache, insert_documents, known_docnos
+from models.database import clear_missing, record_missing, recently_missing, write_transaction
 from sys import stdout
 import re
 import os
-
-
-DOWNLOAD_WORKERS = 3
+import threading
+
+
+# Number of downloads in flight.  Each one blocks a thread, but they are
+# mostly waiting for the network, so this can be much higher than the limits
+# below, which keep us polite towards the document server (dipbt).
+DOWNLOAD_WORKERS = 16
+# Initial number of concurrent requests to the document server, and the
+# bounds within which it adapts to the latency and error rate of the server
+DOWNLOAD_HOST_LIMIT = 4
+DOWNLOAD_HOST_MIN = 1
+DOWNLOAD_HOST_MAX = 16
+# Maximum number of requests per second to the document server, and the
+# number of requests that may be sent at once after an idle period
+DOWNLOAD_RATE = 10
+DOWNLOAD_BURST = 10
+# Base URLs serving the same documents as the document server.  Slow
+# downloads are hedged with a second request to the first of them.
+DOC_MIRRORS = ["https://dipbt.bundestag.de"]
 INSERT_WORKERS = 2
+# Number of times a download or metadata lookup failing on an unreachable
+# server is retried, and the base and maximum delay in seconds before that.
+# The requests themselves are only tried once, so the workers never sleep.
+ITEM_RETRIES = 5
+ITEM_RETRY_DELAY = 30
+ITEM_RETRY_MAX_DELAY = 600
+CONVERT_WORKERS = 2
+# Number of threads scraping metadata, and the maximum number of concurrent
+# requests to the pdok server (to stay clear of its rate limits)
+META_WORKERS = 6
+META_HOST_LIMIT = 4
+
+# Number of consecutive missing documents after which we assume that the end
+# of the regular numbering range of a period has been reached
+PROBE_MISS_CUTOFF = 20
+# Number of consecutive missing documents above the last known document that
+# are probed when following the open period
+FOLLOW_WINDOW = 50
+# Upper limits (exclusive) of the regular numbering ranges
+PLENARY_LIMIT = 1000
+DRUCKSACHE_LIMIT = 20000
+# Number ranges (start inclusive, end exclusive) outside of the regular
+# numbering that are known to contain documents, e.g. the Bundesversammlungen
+# (16/300, 17/500, 17/907, 18/909) or the Unterrichtungen 06/10001-10003.
+# These are far too sparse to be found by the upper bound search, so they are
+# always queued in full.
+SPARSE_RANGES_PLENARY = [(300, 301), (500, 501), (900, 1000)]
+SPARSE_RANGES_DRUCKSACHE = [(10001, 10011)]
+
+# Seconds until a document number confirmed missing is probed again, for the
+# open period and for periods that have been completely scraped.  Every time
+# a number is confirmed missing again, this is doubled up to the maximum.
+MISSING_TTL_OPEN = 24 * 60 * 60
+MISSING_TTL_CLOSED = 30 * 24 * 60 * 60
+MISSING_TTL_MAX = 365 * 24 * 60 * 60
 
 BASEURL_META_PLENARY = "http://pdok.bundestag.de/treffer.php?q={}&wp=&dart=Plenarprotokoll"
 BASEURL_META_DRUCKSACHE = "http://pdok.bundestag.de/treffer.php?q={}&wp=&dart=Drucksache"
@@ -36,159 +94,592 @@ BASEURL_DOC_DRUCKSACHE = "http://dipbt.bundestag.de/doc/btd/{0}/{1}/{0}{2}.pdf"
 BASEPATH_FILE_PLENARY = "documents/{0}/Plenarprotokoll/{0}{1}.pdf"
 BASEPATH_FILE_DRUCKSACHE = "documents/{0}/Drucksache/{0}{1}.pdf"
 
+# Whether setup_hosts has run
+_hosts_configured = False
+_setup_lock = threading.Lock()
+
 
-def scrape_period(period_no_numeric, max_period):
+def scrape_period(period_no_numeric, max_period, force=False):
     """Scrape all data for a specific election period.
 
     Arguments:
     period_no_numeric -- The number of the period.
+    max_period        -- The number of the current (open) period.
+    force             -- Scrape the period even if it has been scraped before.
     """
     # Format period number properly
     period_no = '%02d' % period_no_numeric
     # Get from database or create
-    period = Wahlperiode.get_or_create(period_no=period_no)[0]
+    with write_transaction():
+        period = Wahlperiode.get_or_create(period_no=period_no)[0]
 
     # If the period has already been scraped, return instantly
-    if period.period_scraped:
+    if period.period_scraped and not force:
         print "INFO: Period", period_no, "has already been scraped - skipping"
         return
 
-    # Ensure directory structure exists
-    if not os.path.exists('documents/' + period_no + "/Plenarprotokoll"):
-        os.makedirs('documents/' + period_no + "/Plenarprotokoll")
-    if not os.path.exists('documents/' + period_no + "/Drucksache"):
-        os.makedirs('documents/' + period_no + "/Drucksache")
+    setup_period(period_no)
 
     # Scrape all Plenarprotokolle
     print "INFO: Scraping Plenarprotokolle for period", period_no
-    scrape_period_plenarprotokoll(period)
+    complete = scrape_period_plenarprotokoll(period)
     # Scrape Drucksachen
     print "INFO: Scraping Drucksachen for period", period_no
-    scrape_period_drucksachen(period)
+    complete = scrape_period_drucksachen(period) and complete
 
     # Check if we have processed an old period, and if yes, mark it as
-    # completely downloaded (in the hopes that all downloaded files are in
-    # order, and none of them failed)
-    # TODO Maybe add a check that all files are indeed application/pdf files
-    #      before marking the period as completed, just to be sure?
+    # completely downloaded, unless some documents could not be fetched (e.g.
+    # because the server was down), which are then retried on the next run
     if period_no_numeric < max_period:
-        print "INFO: Marking period", period_no, "as completely scraped."
-        period.period_scraped = True
+        if complete:
+            print "INFO: Marking period", period_no, "as completely scraped."
+            period.period_scraped = True
+        else:
+            print "WARN: Some documents of period", period_no, "could not be fetched -",
+            print "not marking it as completely scraped"
 
     # Save changes to the period database entry
-    period.save()
+    with write_transaction():
+        period.save()
 
 
-def scrape_period_plenarprotokoll(period):
-    """Scrape the website for Plenarprotokolle in the given period.
+def follow_period(period_no_numeric, deep=False):
+    """Cheaply pick up new documents of the open period.
+
+    Only the numbers above the processed-number watermarks of the period are
+    probed, up to FOLLOW_WINDOW numbers past the last document found, which
+    makes this suitable for running from cron.  Lower numbers and the sparse
+    ranges are only revisited on a deep check, which is a regular scrape of
+    the period that also re-probes the numbers recently confirmed missing.
 
     Arguments:
-    period -- A models.database.Wahlperiode object
+    period_no_numeric -- The number of the period.
+    deep              -- Re-check the whole period instead.
     """
-    pool = ThreadPool(processes=DOWNLOAD_WORKERS)
-    workqueue = []
-    for number in range(1, 1000):
-        # We do not start from the highest already scraped plenary because
-        # the download code also checks if the file was successfully downloaded
-        # as a PDF file.  Thus, if any error sneaks through on one pass, e.g.
-        # because the server is unavailable for a moment, it will get fixed
-        # automatically on the next pass.
-        # As the metadata remains unchanged, we don't need to reprocess these
-        # files in the database.
-        number = '%03d' % number
-        url = BASEURL_DOC_PLENARY.format(period.period_no, number)
-        file = BASEPATH_FILE_PLENARY.format(period.period_no, number)
+    period_no = '%02d' % period_no_numeric
+    with write_transaction():
+        period = Wahlperiode.get_or_create(period_no=period_no)[0]
+    setup_period(period_no)
+
+    print "INFO: Following Plenarprotokolle for period", period_no
+    scrape_period_plenarprotokoll(period, follow=not deep, deep=deep)
+    print "INFO: Following Drucksachen for period", period_no
+    scrape_period_drucksachen(period, follow=not deep, deep=deep)
+    with write_transaction():
+        period.save()
 
-        # Queue up download
-        workqueue += [(url, file)]
 
-    # TODO Add progress bars to all of this
-    # Perform download
-    print "INFO: Downloading Plenarprotokolle...",
-    stdout.flush()
-    results = pool.map(_download_tuple, workqueue)
-    print "DONE."
+def rebuild_period(period_no_numeric):
+    """Rebuild the database entries of a period from the downloaded files.
 
-    # Close and terminate pool
-    pool.close()
-    pool.join()
+    No documents are downloaded, only the metadata is retrieved.  Together
+    with the offline mode of util.cache, this needs no network access at all
+    for previously scraped periods.
 
-    # Create background process for pdftotext operations
-    p = Process(target=pdf_to_text, args=(results, ), name="conv_plenary")
-    p.start()
+    Arguments:
+    period_no_numeric -- The number of the period.
+    """
+    period_no = '%02d' % period_no_numeric
+    with write_transaction():
+        period = Wahlperiode.get_or_create(period_no=period_no)[0]
+
+    print "INFO: Rebuilding Plenarprotokolle for period", period_no
+    indexer = Indexer(Plenarprotokoll)
+    writer = DocumentWriter(Plenarprotokoll, period, 'plenary_max', indexer)
+    harvester = MetadataHarvester(period_no, "Plenarprotokoll")
+    rebuild_documents(os.path.dirname(BASEPATH_FILE_PLENARY.format(period_no, "")),
+                      lambda path: prepare_plenarprotokoll(period, writer.known, path, harvester),
+                      lambda record: process_plenarprotokoll(writer, record), indexer)
+    writer.flush()
+    indexer.flush()
+
+    print "INFO: Rebuilding Drucksachen for period", period_no
+    indexer = Indexer(Drucksache)
+    writer = DocumentWriter(Drucksache, period, 'drucksache_max', indexer)
+    harvester = MetadataHarvester(period_no, "Drucksache")
+    rebuild_documents(os.path.dirname(BASEPATH_FILE_DRUCKSACHE.format(period_no, "")),
+                      lambda path: prepare_drucksache(period, writer.known, path, harvester),
+                      lambda record: process_drucksache(writer, record), indexer)
+    writer.flush()
+    indexer.flush()
+    with write_transaction():
+        period.save()
 
-    print "INFO: Inserting to database...",
-    stdout.flush()
-    for result in results:
-        process_plenarprotokoll(period, result)
 
-    # Wait for conversion worker to finish
-    print "DONE."
-    print "INFO: Waiting for text file conversion to finish...",
+def rebuild_documents(directory, prepare, process, indexer=None):
+    """Feed all valid PDF files in a directory through the pipeline.
+
+    Arguments:
+    directory -- the directory of a document type of a period
+    prepare   -- function collecting the metadata for a file
+    process   -- function writing the result of prepare to the database
+    indexer   -- a util.fulltext.Indexer for the document type
+    """
+    if not os.path.isdir(directory):
+        return
+    pipeline = build_pipeline(prepare, process,
+                              lambda path: path if manifest.is_valid(path) else None,
+                              indexer=indexer)
+    # The file names are zero-padded, so this feeds them in numerical order,
+    # as the database writer expects
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".pdf"):
+            pipeline.feed(os.path.join(directory, filename))
+    pipeline.close()
+
+
+def setup_period(period_no):
+    """Prepare connections and directories for scraping a period.
+
+    Arguments:
+    period_no -- The formatted number of the period (e.g. 06)
+    """
+    setup_hosts()
+
+    # Ensure directory structure exists
+    for doctype in ("Plenarprotokoll", "Drucksache"):
+        directory = 'documents/' + period_no + "/" + doctype
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Already exists (possibly created by a concurrent scrape)
+            if not os.path.isdir(directory):
+                raise
+
+
+def setup_hosts():
+    """Configure the connections and limits for the servers, once.
+
+    The limits are shared by all periods scraped at the same time, so they
+    must not be reset by every period.
+    """
+    global _hosts_configured
+    with _setup_lock:
+        if _hosts_configured:
+            return
+        # Keep one keep-alive connection per concurrent request open to each
+        # host (the host limits cover the whole download, including the body)
+        configure_session(BASEURL_DOC_PLENARY, DOWNLOAD_HOST_MAX)
+        set_host_limit(BASEURL_DOC_PLENARY, DOWNLOAD_HOST_LIMIT, DOWNLOAD_RATE, DOWNLOAD_BURST,
+                       DOWNLOAD_HOST_MIN, DOWNLOAD_HOST_MAX)
+        set_mirrors(BASEURL_DOC_PLENARY, DOC_MIRRORS)
+        configure_session(BASEURL_META_PLENARY, META_HOST_LIMIT)
+        set_host_limit(BASEURL_META_PLENARY, META_HOST_LIMIT)
+        _hosts_configured = True
+
+
+def scrape_period_plenarprotokoll(period, follow=False, deep=False):
+    """Scrape the website for Plenarprotokolle in the given period.
+
+    Arguments:
+    period -- A models.database.Wahlperiode object
+    follow -- Only probe numbers above the watermark of the period
+    deep   -- Also probe the numbers recently confirmed missing
+
+    Returns True if all documents could be checked, False if some probes or
+    downloads failed for good.
+    """
+    # Find the end of the regular numbering range first, instead of blindly
+    # probing every possible number
+    start = probe_start(period.plenary_max, SPARSE_RANGES_PLENARY)
+    probes = ProbeTracker(period, Plenarprotokoll, start, cached=not deep, remember=not follow)
+    try:
+        bound = find_upper_bound(
+            lambda n: probes.exists(n, BASEURL_DOC_PLENARY.format(period.period_no, '%03d' % n)),
+            start=start, limit=PLENARY_LIMIT,
+            cutoff=FOLLOW_WINDOW if follow else PROBE_MISS_CUTOFF)
+    except RequestFailed as e:
+        # Do not take a failed probe for the end of the numbering range, only
+        # check the numbers up to the last known document this time
+        print "WARN: Probing for the end of the numbering range failed:", e
+        bound = start
+    print "INFO: Highest regular Plenarprotokoll number appears to be", bound
+
+    indexer = Indexer(Plenarprotokoll)
+    writer = DocumentWriter(Plenarprotokoll, period, 'plenary_max', indexer)
+    harvester = MetadataHarvester(period.period_no, "Plenarprotokoll", bound)
+    stats = Throughput()
+    pipeline = build_pipeline(lambda path: prepare_plenarprotokoll(period, writer.known, path, harvester),
+                              lambda record: process_plenarprotokoll(writer, record),
+                              probes.download, stats, indexer)
+
+    # TODO Add progress bars to all of this
+    print "INFO: Downloading and processing Plenarprotokolle...",
     stdout.flush()
-    p.join()
+    # Follow runs only look at the numbers above the watermark, and leave the
+    # sparse ranges to the regular (or deep) runs
+    first = start + 1 if follow else 1
+    sparse = [] if follow else SPARSE_RANGES_PLENARY
+    for number in probes.wanted(probe_numbers(bound, sparse, first)):
+        # Outside of follow runs, we do not start from the highest already
+        # scraped plenary because the download code also checks if the file
+        # was successfully downloaded as a PDF file.  Thus, if any error sneaks
+        # through on one pass, e.g. because the server is unavailable for a
+        # moment, it will get fixed automatically on the next regular pass.
+        # As the metadata remains unchanged, we don't need to reprocess these
+        # files in the database.
+        url = BASEURL_DOC_PLENARY.format(period.period_no, '%03d' % number)
+        file = BASEPATH_FILE_PLENARY.format(period.period_no, '%03d' % number)
+
+        # Queue up download
+        pipeline.feed((number, url, file))
+
+    # Wait for all downloads, database inserts and conversions to finish
+    pipeline.close()
+    writer.flush()
+    indexer.flush()
+    probes.save(bound)
     print "DONE."
+    if len(probes.skipped) > 0:
+        print "WARN: Skipped", len(probes.skipped), "numbers for which the server did not send a PDF"
+    stats.report()
+    print "INFO: Concurrent downloads settled at", host_limit(BASEURL_DOC_PLENARY)
+    print "INFO: Hedged %d of %d downloads" % hedge_stats(BASEURL_DOC_PLENARY)[::-1]
+    return probes.unknown == 0 and pipeline.failures() == 0
 
 
-def scrape_period_drucksachen(period):
+def scrape_period_drucksachen(period, follow=False, deep=False):
     """Scrape the website for Drucksachen in the given period.
 
     Arguments:
     period -- A models.database.Wahlperiode object
+    follow -- Only probe numbers above the watermark of the period
+    deep   -- Also probe the numbers recently confirmed missing
+
+    Returns True if all documents could be checked, False if some probes or
+    downloads failed for good.
     """
-    pool = ThreadPool(processes=DOWNLOAD_WORKERS)
-    workqueue = []
-    for number in range(0 + 1, 20000):
-        # We do not start from the highest already scraped Drucksache because
-        # the download code also checks if the file was successfully downloaded
-        # as a PDF file.  Thus, if any error sneaks through on one pass, e.g.
-        # because the server is unavailable for a moment, it will get fixed
-        # automatically on the next pass.
+    # Find the end of the regular numbering range first
+    start = probe_start(period.drucksache_max, SPARSE_RANGES_DRUCKSACHE)
+    probes = ProbeTracker(period, Drucksache, start, cached=not deep, remember=not follow)
+    try:
+        bound = find_upper_bound(
+            lambda n: probes.exists(n, drucksache_url(period.period_no, n)),
+            start=start, limit=DRUCKSACHE_LIMIT,
+            cutoff=FOLLOW_WINDOW if follow else PROBE_MISS_CUTOFF)
+    except RequestFailed as e:
+        # Do not take a failed probe for the end of the numbering range, only
+        # check the numbers up to the last known document this time
+        print "WARN: Probing for the end of the numbering range failed:", e
+        bound = start
+    print "INFO: Highest regular Drucksache number appears to be", bound
+
+    indexer = Indexer(Drucksache)
+    writer = DocumentWriter(Drucksache, period, 'drucksache_max', indexer)
+    harvester = MetadataHarvester(period.period_no, "Drucksache", bound)
+    stats = Throughput()
+    pipeline = build_pipeline(lambda path: prepare_drucksache(period, writer.known, path, harvester),
+                              lambda record: process_drucksache(writer, record),
+                              probes.download, stats, indexer)
+
+    # TODO Add progress bars
+    print "INFO: Downloading and processing Drucksachen...",
+    stdout.flush()
+    # Follow runs only look at the numbers above the watermark, and leave the
+    # sparse ranges to the regular (or deep) runs
+    first = start + 1 if follow else 1
+    sparse = [] if follow else SPARSE_RANGES_DRUCKSACHE
+    for number in probes.wanted(probe_numbers(bound, sparse, first)):
+        # Outside of follow runs, we do not start from the highest already
+        # scraped Drucksache because the download code also checks if the file
+        # was successfully downloaded as a PDF file.  Thus, if any error sneaks
+        # through on one pass, e.g. because the server is unavailable for a
+        # moment, it will get fixed automatically on the next regular pass.
         # As the metadata remains unchanged, we don't need to reprocess these
         # files in the database.
-        number = "%05d" % number
-        prefix = number[:3]
-
         # Prepare url and path
-        url = BASEURL_DOC_DRUCKSACHE.format(period.period_no, prefix, number)
-        file = BASEPATH_FILE_DRUCKSACHE.format(period.period_no, number)
+        url = drucksache_url(period.period_no, number)
+        file = BASEPATH_FILE_DRUCKSACHE.format(period.period_no, "%05d" % number)
 
         # Queue up
-        workqueue += [(url, file)]
+        pipeline.feed((number, url, file))
 
-    # TODO Add progress bars
-    # Perform download
-    print "INFO: Downloading Drucksachen...",
-    stdout.flush()
-    results = pool.map(_download_tuple, workqueue)
+    # Wait for all downloads, database inserts and conversions to finish
+    pipeline.close()
+    writer.flush()
+    indexer.flush()
+    probes.save(bound)
     print "DONE."
+    if len(probes.skipped) > 0:
+        print "WARN: Skipped", len(probes.skipped), "numbers for which the server did not send a PDF"
+    stats.report()
+    print "INFO: Concurrent downloads settled at", host_limit(BASEURL_DOC_PLENARY)
+    print "INFO: Hedged %d of %d downloads" % hedge_stats(BASEURL_DOC_PLENARY)[::-1]
+    return probes.unknown == 0 and pipeline.failures() == 0
 
-    # Close and terminate pool
-    pool.close()
-    pool.join()
 
-    # Create background process for pdftotext operations
-    p = Process(target=pdf_to_text, args=(results, ), name="conv_druck")
-    p.start()
+def build_pipeline(prepare, process, fetch, stats=None, indexer=None):
+    """Build and start the download pipeline for one document type.
+
+    Every downloaded file is passed on to the metadata stage and the text
+    conversion stage as soon as it lands, instead of waiting for all
+    downloads of the period to finish.  The metadata workers pass their
+    results on to a single database writer, which processes them in download
+    order, as it relies on the processed-number watermarks.  Files identical
+    to an earlier document are replaced by hardlinks as soon as they land.
+
+    Arguments:
+    prepare -- function collecting the metadata for a downloaded file (path
+               or None)
+    process -- function writing the result of prepare to the database
+    fetch   -- function getting the file of a work item, returning its path
+               or None (e.g. ProbeTracker.download)
+    stats   -- a util.convert.Throughput object counting the conversions
+    indexer -- a util.fulltext.Indexer adding the converted documents to the
+               full-text index, or None
+
+    Returns the started util.pipeline.Pipeline, to be fed with the work items
+    for fetch.
+    """
+    retry = dict(retry_on=RequestFailed, retries=ITEM_RETRIES,
+                 backoff=lambda attempt: backoff_delay(attempt, ITEM_RETRY_DELAY, ITEM_RETRY_MAX_DELAY))
+    pipeline = Pipeline()
+    download = pipeline.add(Stage("download", lambda task: deduplicate(fetch(task)),
+                                  workers=DOWNLOAD_WORKERS, **retry))
+    metadata = pipeline.add(Stage("metadata", prepare, workers=META_WORKERS, **retry), after=download)
+    pipeline.add(Stage("database", process, ordered=True), after=metadata)
+    if pdftotext_available():
+        convert = pipeline.add(Stage("convert", lambda path: convert_document(path, stats),
+                                     workers=CONVERT_WORKERS), after=download)
+        if indexer is not None:
+            pipeline.add(Stage("index", indexer.add), after=convert)
+    else:
+        print "WARN: Please install pdftotext to enable automatic conversion to text files"
+    pipeline.start()
+    return pipeline
+
+
+def convert_document(path, stats=None):
+    """Convert a downloaded document to text, if it has not been converted yet.
+
+    Arguments:
+    path  -- the path to the downloaded file, or None
+    stats -- a util.convert.Throughput object counting the conversions
+
+    Returns the path if the document has a text version, None otherwise.
+    """
+    convert_pdf(path, stats=stats)
+    if path is not None and os.path.isfile(path[:-4] + ".txt"):
+        return path
+    return None
+
+
+class ProbeTracker(object):
+    """Negative cache of probed document numbers for one period and type.
+
+    Numbers that were recently confirmed missing are not probed again until
+    their TTL has expired.  All probe results of a run are collected, and
+    written back to the database at the end.
+
+    Only gaps in the numbering are cached: a missing number above the highest
+    existing document has most likely not been published yet, so it is
+    probed again on every run.
+    """
+
+    def __init__(self, period, model, start, cached=True, remember=True):
+        """Load the recently missing numbers.
+
+        Arguments:
+        period   -- a models.database.Wahlperiode object
+        model    -- the document model (Drucksache or Plenarprotokoll)
+        start    -- a number known to exist, only missing numbers below it
+                    are skipped
+        cached   -- skip the recently missing numbers (False re-probes them)
+        remember -- record the missing numbers of this run
+        """
+        self.period = period
+        self.doctype = model.__name__
+        self.remember = remember
+        if cached:
+            self.skip = set(number for number in recently_missing(period, self.doctype)
+                            if number < start)
+        else:
+            self.skip = set()
+        self.missing = set()
+        self.found = set()
+        # Number of probes that failed, leaving it unknown if the number exists
+        self.unknown = 0
+        # Number of attempts of the numbers for which the server did not send
+        # a PDF, and the numbers that were skipped for that reason
+        self.not_pdf = {}
+        self.skipped = set()
+        self._lock = threading.Lock()
+
+    def wanted(self, numbers):
+        """Filter out the numbers that do not need to be probed."""
+        return [number for number in numbers if number not in self.skip]
+
+    def exists(self, number, url):
+        """Check if a document number exists, using the cache if possible.
+
+        Raises RequestFailed if the server could not be reached, as the
+        number may well exist.
+        """
+        if number in self.skip:
+            return False
+        try:
+            found = url_exists(url)
+        except RequestFailed:
+            with self._lock:
+                self.unknown += 1
+            raise
+        self._record(number, found)
+        return found
+
+    def download(self, task):
+        """Download a document, given as a (number, url, path) tuple."""
+        number, url, file = task
+        # Unreachable servers and incomplete downloads raise RequestFailed
+        # (retried by the pipeline), so None really means that the document
+        # is missing
+        try:
+            path = download(url, file, wait=False)
+        except NotPdf:
+            with self._lock:
+                attempts = self.not_pdf.get(number, 0) + 1
+                self.not_pdf[number] = attempts
+            if attempts <= ITEM_RETRIES:
+                raise
+            # The server keeps sending something else, so give up on the
+            # number like on a missing one (it is re-probed once its TTL
+            # expires), instead of failing the whole period on every run
+            print "ERROR: Server did not send a PDF for", file, "- skipping"
+            with self._lock:
+                self.skipped.add(number)
+            path = None
+        self._record(number, path is not None)
+        return path
+
+    def _record(self, number, found):
+        """Record the result of a probe."""
+        with self._lock:
+            if found:
+                self.found.add(number)
+            else:
+                self.missing.add(number)
+
+    def save(self, bound):
+        """Write the probe results to the database.
+
+        Arguments:
+        bound -- the highest number of the regular numbering range, missing
+                 numbers above it are not cached (and forgotten if they were)
+        """
+        if self.period.period_scraped:
+            ttl = MISSING_TTL_CLOSED
+        else:
+            ttl = MISSING_TTL_OPEN
+        if self.remember:
+            record_missing(self.period, self.doctype,
+                           set(number for number in self.missing - self.found if number < bound),
+                           ttl, MISSING_TTL_MAX)
+        clear_missing(self.period, self.doctype, self.found, above=bound)
+
+
+def drucksache_url(period_no, number):
+    """Assemble the download URL of a Drucksache.
+
+    Arguments:
+    period_no -- The formatted number of the period (e.g. 06)
+    number    -- The number of the Drucksache as an integer
+    """
+    number = "%05d" % number
+    return BASEURL_DOC_DRUCKSACHE.format(period_no, number[:3], number)
 
-    print "INFO: Inserting into database...",
-    stdout.flush()
-    for result in results:
-        process_drucksache(period, result)
-    print "DONE"
-    # Wait for text file conversion to finish
-    print "INFO: Waiting for text file conversion to finish...",
-    stdout.flush()
-    p.join()
-    print "DONE."
 
+def find_upper_bound(exists, start=0, limit=DRUCKSACHE_LIMIT, cutoff=PROBE_MISS_CUTOFF):
+    """Find the highest document number of the regular numbering range.
 
-def process_plenarprotokoll(period, path):
-    """Process a downloaded Plenarprotokoll.
+    The search gallops upwards from the last known document until it
+    overshoots, then bisects between the last hit and the first miss.  As the
+    numbering contains gaps, the result is only accepted once the following
+    `cutoff` numbers have all been confirmed missing - otherwise, the search
+    continues from the document that was found.  Overall, this takes a few
+    dozen requests instead of one request per possible number.
 
     Arguments:
-    period -- A models.database.Wahlperiode the Plenarprotokoll belongs to
-    path   -- The path to the downloaded file, or None if no file was downloaded
+    exists -- a function taking a number and returning True if it exists
+              (exceptions, e.g. for a failed probe, abort the search)
+    start  -- a number known to exist (or 0 if none is known)
+    limit  -- upper limit (exclusive) of the numbering range
+    cutoff -- number of consecutive misses that ends the search
+
+    Returns the highest number found, or 0 if no document exists.
+    """
+    last_hit = start
+    while True:
+        # Gallop upwards in growing steps until we hit a missing number
+        step = 1
+        miss = limit
+        while last_hit + step < limit:
+            if not exists(last_hit + step):
+                miss = last_hit + step
+                break
+            last_hit += step
+            step *= 2
+
+        # Bisect between the last hit and the first miss
+        while miss - last_hit > 1:
+            middle = (last_hit + miss) // 2
+            if exists(middle):
+                last_hit = middle
+            else:
+                miss = middle
+
+        # Check that we have not just found a gap in the numbering
+        for number in range(miss + 1, min(last_hit + 1 + cutoff, limit)):
+            if exists(number):
+                last_hit = number
+                break
+        else:
+            return last_hit
+
+
+def probe_start(watermark, sparse_ranges):
+    """Get the number from which the upper bound search can start.
+
+    The highest processed number is known to exist, unless it belongs to one
+    of the sparse ranges (in which case it says nothing about the regular
+    numbering range, and we have to start from scratch).
+
+    Arguments:
+    watermark     -- the highest processed number of the period
+    sparse_ranges -- list of (start, end) ranges that are always probed
+    """
+    for start, end in sparse_ranges:
+        if start <= watermark < end:
+            return 0
+    return watermark
+
+
+def probe_numbers(bound, sparse_ranges, first=1):
+    """Get the sorted list of document numbers that should be downloaded.
+
+    Arguments:
+    bound         -- the highest number of the regular numbering range
+    sparse_ranges -- list of (start, end) ranges that should always be probed
+    first         -- the lowest number of the regular numbering range to probe
+    """
+    numbers = set(range(first, bound + 1))
+    for start, end in sparse_ranges:
+        numbers.update(range(start, end))
+    return sorted(numbers)
+
+
+def prepare_plenarprotokoll(period, known, path, harvester=None):
+    """Collect the database record for a downloaded Plenarprotokoll.
+
+    This runs on the metadata workers, so it must not write to the database.
+
+    Arguments:
+    period    -- A models.database.Wahlperiode the Plenarprotokoll belongs to
+    known     -- set of document numbers that are already in the database
+    path      -- The path to the downloaded file, or None if no file was
+                 downloaded
+    harvester -- A controller.harvester.MetadataHarvester for the period
+
+    Returns a tuple (number, fields), where fields is None if the database
+    entry already exists, or None if there is nothing to process.
     """
     if path is None:
         return
@@ -204,16 +695,16 @@ def process_plenarprotokoll(period, path):
         return
 
     # Check if database entry already exists
-    try:
-        Plenarprotokoll.get(docno=docno)
-        period.plenary_max = number_part
+    if docno in known:
         # print "WARN: Database entry for plenary", docno, "already exists. Skipping"
-        return
-    except DoesNotExist:
-        pass
+        return (number_part, None)
 
-    # Retrieve metadata on entry
-    metadata = scrape_plenarprotokoll_meta(docno)
+    # Retrieve metadata on entry, from the harvested listing if possible
+    hit = harvester.lookup(docno) if harvester is not None else None
+    if hit is not None and check_hardcoded_cornercases_plenary(docno) is None:
+        metadata = hit[:2]
+    else:
+        metadata = scrape_plenarprotokoll_meta(docno)
     if metadata is not None:
         title, date = metadata
     else:
@@ -224,25 +715,53 @@ def process_plenarprotokoll(period, path):
         print "ERROR: Scraping plenary meta appears to have failed for docno", docno
         return
 
-    # Create new database entry
     source = BASEURL_DOC_PLENARY.format(filename[:2], filename[2:])
-    Plenarprotokoll.create(docno=docno, date=date, path=path,
-                           period=period, title=title, source=source)
+    fields = dict(docno=docno, date=date, path=path, title=title, source=source)
+    fields.update(file_validators(path))
+    return (number_part, fields)
+
+
+def process_plenarprotokoll(writer, record):
+    """Write a prepared Plenarprotokoll to the database.
+
+    Arguments:
+    writer -- The DocumentWriter for the Plenarprotokolle of the period
+    record -- The result of prepare_plenarprotokoll
+    """
+    if record is None:
+        return
+    number_part, fields = record
+
+    # Database entry already exists
+    if fields is None:
+        writer.advance(number_part)
+        return
+
+    # Queue new database entry
+    writer.add(fields)
 
     # Update maximum processed number, modulo special cases (which are always
     # above 399, as experience shows).  This allows us to later skip already
     # processed documents more efficiently (compared to querying the database
     # for each document, which is quite a drag on performance using SQLite)
     if number_part < 399:
-        period.plenary_max = number_part
+        writer.advance(number_part)
+
 
+def prepare_drucksache(period, known, path, harvester=None):
+    """Collect the database record for a downloaded Drucksache.
 
-def process_drucksache(period, path):
-    """Process a downloaded Drucksache.
+    This runs on the metadata workers, so it must not write to the database.
 
     Arguments:
-    period -- A models.database.Wahlperiode the Drucksache belongs to
-    path   -- The path to the downloaded file, or None if no file was downloaded
+    period    -- A models.database.Wahlperiode the Drucksache belongs to
+    known     -- set of document numbers that are already in the database
+    path      -- The path to the downloaded file, or None if no file was
+                 downloaded
+    harvester -- A controller.harvester.MetadataHarvester for the period
+
+    Returns a tuple (number, fields), where fields is None if the database
+    entry already exists, or None if there is nothing to process.
     """
     if path is None:
         return
@@ -256,17 +775,16 @@ def process_drucksache(period, path):
     if number_part <= period.drucksache_max:
         return
     # Check if database entry already exists
-    try:
-        Drucksache.get(docno=docno)
+    if docno in known:
         # print "WARN: Database entry for Drucksache", docno, "already exists. Skipping"
-        period.drucksache_max = number_part
-        period.save()
-        return
-    except DoesNotExist:
-        pass
+        return (number_part, None)
 
-    # Retrieve metadata on entry
-    metadata = scrape_drucksache_meta(docno)
+    # Retrieve metadata on entry, from the harvested listing if possible
+    hit = harvester.lookup(docno) if harvester is not None else None
+    if hit is not None and hit[2] is not None and check_hardcoded_cornercases_drucksache(docno) is None:
+        metadata = hit
+    else:
+        metadata = scrape_drucksache_meta(docno)
     if metadata is not None:
         title, date, doctype, urheber, autor = metadata
     else:
@@ -276,14 +794,93 @@ def process_drucksache(period, path):
         print "ERROR: Scraping plenary meta appears to have failed for docno", docno
         return
 
-    # Create new database entry
     source = BASEURL_DOC_DRUCKSACHE.format(filename[:2], filename[2:5], filename[2:])
-    Drucksache.create(docno=docno, date=date, path=path, period=period,
-                      title=title, doctype=doctype, urheber=urheber,
-                      autor=autor, source=source)
+    fields = dict(docno=docno, date=date, path=path, title=title,
+                  doctype=doctype, urheber=urheber, autor=autor, source=source)
+    fields.update(file_validators(path))
+    return (number_part, fields)
+
+
+def file_validators(path):
+    """Get the HTTP validators and digests of a downloaded file from the manifest.
+
+    Returns a dict with the etag, last_modified, content_length, sha256, md5
+    and duplicate_of fields of a document.
+    """
+    entry = manifest.lookup(path)
+    if entry is None:
+        return dict(etag=None, last_modified=None, content_length=None, sha256=None, md5=None,
+                    duplicate_of=None)
+    return dict(etag=entry.etag, last_modified=entry.last_modified,
+                content_length=entry.size, sha256=entry.sha256, md5=entry.md5,
+                duplicate_of=manifest.original(path))
+
+
+def process_drucksache(writer, record):
+    """Write a prepared Drucksache to the database.
+
+    Arguments:
+    writer -- The DocumentWriter for the Drucksachen of the period
+    record -- The result of prepare_drucksache
+    """
+    if record is None:
+        return
+    number_part, fields = record
+
+    # Queue new database entry, unless it already exists
+    if fields is not None:
+        writer.add(fields)
 
     # Update maximum processed Drucksachen-number
-    period.drucksache_max = number_part
+    writer.advance(number_part)
+
+
+class DocumentWriter(object):
+    """Batching database writer for the documents of one period and type.
+
+    New documents are collected and written with a single transaction per
+    batch, together with the processed-number watermark of the period.
+    """
+
+    def __init__(self, model, period, watermark, indexer=None):
+        """Create a new writer and load the existing document numbers.
+
+        Arguments:
+        model     -- the document model (Drucksache or Plenarprotokoll)
+        period    -- the models.database.Wahlperiode to write documents for
+        watermark -- name of the watermark attribute of the period
+        indexer   -- a util.fulltext.Indexer to notify of written documents,
+                     or None
+        """
+        self.model = model
+        self.period = period
+        self.watermark = watermark
+        self.indexer = indexer
+        self.known = known_docnos(model, period)
+        self.number = getattr(period, watermark)
+        self.rows = []
+
+    def add(self, fields):
+        """Queue a new document, given as a dict of field values."""
+        fields['period'] = self.period.dbid
+        self.rows.append(fields)
+        self.known.add(fields['docno'])
+        if len(self.rows) >= BATCH_SIZE:
+            self.flush()
+
+    def advance(self, number):
+        """Set the watermark for the next batch to the given number."""
+        self.number = number
+
+    def flush(self):
+        """Write all queued documents and the watermark to the database."""
+        with write_transaction():
+            insert_documents(self.model, self.rows)
+            setattr(self.period, self.watermark, self.number)
+            self.period.save()
+        if self.indexer is not None and len(self.rows) > 0:
+            self.indexer.documents_written()
+        self.rows = []
 
 
 def scrape_plenarprotokoll_meta(docno):
@@ -300,7 +897,10 @@ def scrape_plenarprotokoll_meta(docno):
     # Assemble URL
     url = BASEURL_META_PLENARY.format(docno)
     # Get HTML
-    html = get_html(url)
+    html = cached_html(url, wait=False)
+    if html is None:
+        print "ERROR: Could not retrieve metadata for", docno
+        return
 
     # Assemble RegEx
     meta_pat = re.compile('<strong>(.+?)</strong>')
@@ -310,9 +910,13 @@ def scrape_plenarprotokoll_meta(docno):
 
     if meta_results is None or len(meta_results) < 3:
         print "ERROR: Parsing metadata for", docno, "failed."
+        # Do not keep unusable results in the cache
+        invalidate(url)
         return
     if meta_results[1] != docno:
         print "ERROR: Got incorrect search result - expected docno", docno, "got", meta_results[1]
+        # Do not keep unusable results in the cache
+        invalidate(url)
         return
 
     # Match title pattern on HTML
@@ -320,6 +924,8 @@ def scrape_plenarprotokoll_meta(docno):
 
     if title_results is None or len(title_results) < 1:
         print "Error: Parsing title for", docno, "failed."
+        # Do not keep unusable results in the cache
+        invalidate(url)
         return
 
     return (title_results[0], meta_results[2])
@@ -343,7 +949,10 @@ def scrape_drucksache_meta(docno):
     # Assemble URL
     url = BASEURL_META_DRUCKSACHE.format(docno)
     # Get HTML
-    html = get_html(url)
+    html = cached_html(url, wait=False)
+    if html is None:
+        print "ERROR: Could not retrieve metadata for", docno
+        return
 
     # Assemble RegEx
     meta_pat = re.compile('<strong>(.+?)</strong>')
@@ -355,9 +964,13 @@ def scrape_drucksache_meta(docno):
 
     if meta_results is None or len(meta_results) < 4:
         print "ERROR: Parsing metadata for", docno, "failed."
+        # Do not keep unusable results in the cache
+        invalidate(url)
         return
     if meta_results[1] != docno:
         print "ERROR: Got incorrect search result - expected docno", docno, "got", meta_results[1]
+        # Do not keep unusable results in the cache
+        invalidate(url)
         return
 
     # Match title pattern on HTML
@@ -365,6 +978,8 @@ def scrape_drucksache_meta(docno):
 
     if title_results is None or len(title_results) < 1:
         print "Error: Parsing title for", docno, "failed."
+        # Do not keep unusable results in the cache
+        invalidate(url)
         return
 
     urheber_results = urheber_pat.findall(html)
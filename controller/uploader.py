@@ -17,15 +17,37 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from internetarchive import upload
-from models.database import Wahlperiode, Drucksache, Plenarprotokoll
-from multiprocessing.pool import ThreadPool
+from internetarchive import search_items, upload
+from models.database import BATCH_SIZE, Wahlperiode, Drucksache, Plenarprotokoll, UploadJob
+from models.database import UPLOAD_DONE, UPLOAD_FAILED, UPLOAD_IN_FLIGHT, UPLOAD_PENDING
+from models.database import add_upload_jobs, write_transaction
+from util.pipeline import Pipeline, Stage
+from util import manifest
+from datetime import datetime
 
 
-def upload_legislaturperiode(period_no_numeric):
+# Number of uploads running in parallel
+UPLOAD_WORKERS = 10
+# Number of attempts after which a failed upload is no longer retried
+UPLOAD_MAX_ATTEMPTS = 5
+# Prefixes of the Internet Archive identifiers of the document types
+IDENTIFIER_PREFIXES = {
+    "Plenarprotokoll": 'ger-bt-plenary-',
+    "Drucksache": 'ger-bt-drucksache-',
+}
+
+
+def upload_legislaturperiode(period_no_numeric, search=None):
     """Upload all files from a legislaturperiode.
 
-    Files that have already been uploaded are ignored.
+    Files that have already been uploaded are ignored.  Once all documents
+    of a completely scraped period are uploaded, the period is marked as
+    uploaded.
+
+    Arguments:
+    period_no_numeric -- The number of the period.
+    search            -- function listing the archive identifiers with a
+                         prefix (default: remote_identifiers)
     """
     # Format period number properly
     period_no = '%02d' % period_no_numeric
@@ -38,101 +60,308 @@ def upload_legislaturperiode(period_no_numeric):
         return
 
     # Upload all plenary protocols
-    upload_plenarprotokoll(period)
+    upload_plenarprotokoll(period, search)
     # Upload all Drucksachen
-    upload_drucksachen(period)
+    upload_drucksachen(period, search)
 
+    # Documents may still be added to the open period, so only completely
+    # scraped periods can be marked
+    if period.period_scraped and uploads_complete(period):
+        print "INFO: Marking period", period_no, "as completely uploaded."
+        with write_transaction():
+            period.period_uploaded = True
+            period.save()
 
-def upload_plenarprotokoll(period):
+
+def upload_plenarprotokoll(period, search=None):
     """Upload all plenary protocols belonging to the given period."""
-    to_upload = []
-    for plenary in Plenarprotokoll.select().where(Plenarprotokoll.period == period):
-        if plenary.archive_ident is not None:
-            continue
-        metadata = dict(collection='deutscherbundestag',
-                        title=plenary.docno + " - " + plenary.title,
-                        mediatype='texts',
-                        source=u'<a href="http://pdok.bundestag.de/" target="blank">Parlamentarisches Dokumentationssystem</a>',
-                        contributor=u'<a href="https://twitter.com/malexmave">@malexmave</a>',
-                        rights=u'Free to republish without modification as long as the source is credited, as per § 5 Abs. 2 UrhG',
-                        publisher=u"Deutscher Bundestag",
-                        creator=u'Deutscher Bundestag',
-                        credits=u"Steganografischer Dienst des Bundestages",  # TODO Add authors / steganografischer Dienst here
-                        description=u'<p>Plenarprotokoll des deutschen Bundestages vom ' + str(plenary.date) + u'.</p><br><p>Automatically mirrored from the german <a href="http://pdok.bundestag.de/" target="blank">parliamentary documentation system</a>. Reproduction without modification allowed as long as the source is credited (according to § 5 Abs. 2 of the german Urheberrecht).</p><p>This is not the authoritative version, but an unofficial mirror. Please check the primary sources when in doubt.</p><p>This post was automatically created using <a href="https://github.com/malexmave/pdok-mirror" target="blank">pdok-mirror</a> and the python <a href="https://internetarchive.readthedocs.io/en/latest/" target="blank">internetarchive</a> library.</p>',  # TODO Update
-                        language=u"ger",
-                        subject=["Deutscher Bundestag", "Plenarprotokoll", "Legislaturperiode " + str(period.period_no)]
-                        )
-        identifier = 'ger-bt-plenary-' + plenary.docno.replace('/', '-')
-        to_upload += [(identifier, {plenary.path.split('/')[-1]: plenary.path}, metadata, plenary)]
-    pool = ThreadPool(processes=10)
-    results = pool.map(upload_parallel, to_upload)
-    pool.close()
-    for result in results:
-        if result is None:
-            continue
-        plenary, identifier = result
-        plenary.archive_ident = identifier
-        print "DEBUG: Successfully uploaded", identifier
-        plenary.save()
-
-
-def upload_drucksachen(period):
+    upload_documents(period, Plenarprotokoll, plenarprotokoll_metadata, search)
+
+
+def upload_drucksachen(period, search=None):
     """Upload all drucksachen belonging to the given period."""
-    to_upload = []
-    for drucksache in Drucksache.select().where(Drucksache.period == period):
-        if drucksache.archive_ident is not None:
-            continue
-        metadata = dict(collection='deutscherbundestag',
-                        title=drucksache.docno + " - " + drucksache.title,
-                        mediatype='texts',
-                        source=u'<a href="http://pdok.bundestag.de/" target="blank">Parlamentarisches Dokumentationssystem</a>',
-                        contributor=u'<a href="https://twitter.com/malexmave">@malexmave</a>',
-                        rights=u'Free to republish without modification as long as the source is credited, as per § 5 Abs. 2 UrhG',
-                        publisher=u"Deutscher Bundestag",
-                        description=u'<p>Drucksache des deutschen Bundestages vom ' + str(drucksache.date) + u'.</p><br><p>Automatically mirrored from the german <a href="http://pdok.bundestag.de/" target="blank">parliamentary documentation system</a>. Reproduction without modification allowed as long as the source is credited (according to § 5 Abs. 2 of the german Urheberrecht).</p><p>This is not the authoritative version, but an unofficial mirror. Please check the primary sources when in doubt.</p><p>This post was automatically created using <a href="https://github.com/malexmave/pdok-mirror" target="blank">pdok-mirror</a> and the python <a href="https://internetarchive.readthedocs.io/en/latest/" target="blank">internetarchive</a> library.</p>',  # TODO Update
-                        language=u"ger",
-                        subject=["Deutscher Bundestag", drucksache.doctype, "Legislaturperiode " + str(period.period_no)]
-                        )
-        if drucksache.autor is not None:
-            metadata['credits'] = drucksache.autor
-        else:
-            metadata['credits'] = u"Unbekannt"
-        if drucksache.urheber is not None:
-            metadata['creator'] = drucksache.urheber
-        else:
-            metadata['creator'] = u"Unbekannt"
-        identifier = 'ger-bt-drucksache-' + drucksache.docno.replace('/', '-')
-        to_upload += [(identifier, {drucksache.path.split('/')[-1]: drucksache.path}, metadata, drucksache)]
-    pool = ThreadPool(processes=10)
-    results = pool.map(upload_parallel, to_upload)
-    pool.close()
-    for result in results:
-        if result is None:
-            continue
-        drucksache, identifier = result
-        drucksache.archive_ident = identifier
-        print "DEBUG: Successfully uploaded", identifier
-        drucksache.save()
-
-
-def upload_parallel(params):
-    """Helper function to upload stuff in parallel."""
-    if params is None or len(params) != 4:
-        print "ERROR: Bad parameters"
+    upload_documents(period, Drucksache, drucksache_metadata, search)
+
+
+def plenarprotokoll_metadata(period, plenary):
+    """Get the Internet Archive metadata of a Plenarprotokoll."""
+    metadata = dict(collection='deutscherbundestag',
+                    title=plenary.docno + " - " + plenary.title,
+                    mediatype='texts',
+                    source=u'<a href="http://pdok.bundestag.de/" target="blank">Parlamentarisches Dokumentationssystem</a>',
+                    contributor=u'<a href="https://twitter.com/malexmave">@malexmave</a>',
+                    rights=u'Free to republish without modification as long as the source is credited, as per § 5 Abs. 2 UrhG',
+                    publisher=u"Deutscher Bundestag",
+                    creator=u'Deutscher Bundestag',
+                    credits=u"Steganografischer Dienst des Bundestages",  # TODO Add authors / steganografischer Dienst here
+                    description=u'<p>Plenarprotokoll des deutschen Bundestages vom ' + str(plenary.date) + u'.</p><br><p>Automatically mirrored from the german <a href="http://pdok.bundestag.de/" target="blank">parliamentary documentation system</a>. Reproduction without modification allowed as long as the source is credited (according to § 5 Abs. 2 of the german Urheberrecht).</p><p>This is not the authoritative version, but an unofficial mirror. Please check the primary sources when in doubt.</p><p>This post was automatically created using <a href="https://github.com/malexmave/pdok-mirror" target="blank">pdok-mirror</a> and the python <a href="https://internetarchive.readthedocs.io/en/latest/" target="blank">internetarchive</a> library.</p>',  # TODO Update
+                    language=u"ger",
+                    subject=["Deutscher Bundestag", "Plenarprotokoll", "Legislaturperiode " + str(period.period_no)]
+                    )
+    return metadata
+
+
+def drucksache_metadata(period, drucksache):
+    """Get the Internet Archive metadata of a Drucksache."""
+    metadata = dict(collection='deutscherbundestag',
+                    title=drucksache.docno + " - " + drucksache.title,
+                    mediatype='texts',
+                    source=u'<a href="http://pdok.bundestag.de/" target="blank">Parlamentarisches Dokumentationssystem</a>',
+                    contributor=u'<a href="https://twitter.com/malexmave">@malexmave</a>',
+                    rights=u'Free to republish without modification as long as the source is credited, as per § 5 Abs. 2 UrhG',
+                    publisher=u"Deutscher Bundestag",
+                    description=u'<p>Drucksache des deutschen Bundestages vom ' + str(drucksache.date) + u'.</p><br><p>Automatically mirrored from the german <a href="http://pdok.bundestag.de/" target="blank">parliamentary documentation system</a>. Reproduction without modification allowed as long as the source is credited (according to § 5 Abs. 2 of the german Urheberrecht).</p><p>This is not the authoritative version, but an unofficial mirror. Please check the primary sources when in doubt.</p><p>This post was automatically created using <a href="https://github.com/malexmave/pdok-mirror" target="blank">pdok-mirror</a> and the python <a href="https://internetarchive.readthedocs.io/en/latest/" target="blank">internetarchive</a> library.</p>',  # TODO Update
+                    language=u"ger",
+                    subject=["Deutscher Bundestag", drucksache.doctype, "Legislaturperiode " + str(period.period_no)]
+                    )
+    if drucksache.autor is not None:
+        metadata['credits'] = drucksache.autor
+    else:
+        metadata['credits'] = u"Unbekannt"
+    if drucksache.urheber is not None:
+        metadata['creator'] = drucksache.urheber
+    else:
+        metadata['creator'] = u"Unbekannt"
+    return metadata
+
+
+def archive_identifier(model, docno):
+    """Get the Internet Archive identifier of a document.
+
+    Arguments:
+    model -- the document model (Drucksache or Plenarprotokoll)
+    docno -- the document number (e.g. 18/37)
+    """
+    return IDENTIFIER_PREFIXES[model.__name__] + docno.replace('/', '-')
+
+
+def upload_documents(period, model, metadata, search=None):
+    """Upload the documents of a period and type that are not uploaded yet.
+
+    Documents that are already in the archive (e.g. uploaded with another
+    database) are found first, and are not uploaded again.  Every other
+    document gets an UploadJob, and every finished upload is committed as
+    soon as it completes, so an interrupted run resumes where it stopped.
+    Uploads that were in flight when the last run stopped are retried, as are
+    failed uploads, up to UPLOAD_MAX_ATTEMPTS times.
+
+    Arguments:
+    period   -- a models.database.Wahlperiode object
+    model    -- the document model (Drucksache or Plenarprotokoll)
+    metadata -- function getting the metadata of a document of the model
+    search   -- function listing the archive identifiers with a prefix
+                (default: remote_identifiers)
+    """
+    doctype = model.__name__
+    preflight(period, model, search or remote_identifiers)
+    queue_uploads(period, model)
+    with write_transaction():
+        (UploadJob.update(state=UPLOAD_PENDING)
+         .where((UploadJob.period == period) & (UploadJob.doctype == doctype) &
+                (UploadJob.state == UPLOAD_IN_FLIGHT))
+         .execute())
+
+    # Uploads finish in any order, and are committed one by one by a single
+    # writer as they do
+    counts = {UPLOAD_DONE: 0, UPLOAD_FAILED: 0}
+    pipeline = Pipeline()
+    uploads = pipeline.add(Stage("upload", _upload_job, workers=UPLOAD_WORKERS))
+    pipeline.add(Stage("commit", lambda result: _commit(result, counts)), after=uploads)
+    pipeline.start()
+    for task in _upload_tasks(period, model, metadata):
+        pipeline.feed(task)
+    pipeline.close()
+    print "INFO: Uploaded", counts[UPLOAD_DONE], doctype, "documents,", counts[UPLOAD_FAILED], "failed"
+
+
+def preflight(period, model, search):
+    """Mark the documents that are already in the archive as uploaded.
+
+    All archive items of the period and type are listed with a single
+    (paged) search, instead of checking every document on its own.  Only
+    documents without an upload job are considered: the others were not in
+    the archive when they were queued, or their archive item is outdated
+    (e.g. the document changed since it was uploaded).
+
+    Arguments:
+    period -- a models.database.Wahlperiode object
+    model  -- the document model (Drucksache or Plenarprotokoll)
+    search -- function listing the archive identifiers with a prefix
+    """
+    queued = UploadJob.select(UploadJob.document).where(
+        (UploadJob.period == period) & (UploadJob.doctype == model.__name__))
+    missing = model.select(model.dbid, model.docno).where(
+        (model.period == period) & (model.archive_ident >> None) & model.dbid.not_in(queued))
+    if not missing.exists():
+        return
+    prefix = archive_identifier(model, period.period_no + "/")
+    try:
+        remote = set(search(prefix))
+    except Exception as e:
+        print "WARN: Listing archive items", prefix + "* failed, uploading all:", e
+        return
+
+    found = []
+    for dbid, docno in missing.tuples().iterator():
+        identifier = archive_identifier(model, docno)
+        if identifier in remote:
+            found.append((dbid, identifier))
+    for i in range(0, len(found), BATCH_SIZE):
+        batch = found[i:i + BATCH_SIZE]
+        with write_transaction():
+            for dbid, identifier in batch:
+                model.update(archive_ident=identifier).where(model.dbid == dbid).execute()
+    print "INFO: Found", len(found), model.__name__, "documents already in the archive"
+
+
+def remote_identifiers(prefix):
+    """List the identifiers of all archive items starting with a prefix.
+
+    Arguments:
+    prefix -- the identifier prefix (e.g. ger-bt-plenary-05-)
+
+    Returns an iterable of identifiers.  The search API pages through the
+    results, so this costs one request per page instead of one per item.
+    """
+    return (item['identifier'] for item in
+            search_items('identifier:%s*' % prefix, fields=['identifier']))
+
+
+def queue_uploads(period, model):
+    """Create upload jobs for the documents that have not been uploaded.
+
+    Documents whose job is done, but which are no longer marked as uploaded
+    (because they changed since), get their job reset.
+
+    The documents are streamed from the database and the jobs are written in
+    batches, so the documents of a period are never all held in memory.
+    """
+    doctype = model.__name__
+    query = (model.select(model.dbid, model.docno)
+             .where((model.period == period) & (model.archive_ident >> None))
+             .tuples())
+    rows = []
+    for dbid, docno in query.iterator():
+        rows.append(dict(identifier=archive_identifier(model, docno), period=period.dbid,
+                         doctype=doctype, document=dbid))
+        if len(rows) >= BATCH_SIZE:
+            add_upload_jobs(rows)
+            rows = []
+    add_upload_jobs(rows)
+
+
+def uploads_complete(period):
+    """Check if all documents of a period have been uploaded."""
+    for model in (Plenarprotokoll, Drucksache):
+        if model.select().where((model.period == period) & (model.archive_ident >> None)).exists():
+            return False
+    return True
+
+
+def _upload_tasks(period, model, metadata):
+    """Generate the upload tasks of a period and type, page by page.
+
+    Yields tuples (job, document, files, metadata).
+    """
+    doctype = model.__name__
+    last = ""
+    while True:
+        jobs = list(UploadJob.select()
+                    .where((UploadJob.period == period) & (UploadJob.doctype == doctype) &
+                           (UploadJob.identifier > last) &
+                           ((UploadJob.state == UPLOAD_PENDING) |
+                            ((UploadJob.state == UPLOAD_FAILED) &
+                             (UploadJob.attempts < UPLOAD_MAX_ATTEMPTS))))
+                    .order_by(UploadJob.identifier)
+                    .limit(BATCH_SIZE))
+        if len(jobs) == 0:
+            return
+        last = jobs[-1].identifier
+        documents = dict((document.dbid, document) for document in
+                         model.select().where(model.dbid << [job.document for job in jobs]))
+        for job in jobs:
+            document = documents.get(job.document)
+            if document is None or document.archive_ident is not None:
+                continue
+            files = {document.path.split('/')[-1]: document.path}
+            yield (job, document, files, metadata(period, document))
+
+
+def _set_state(job, state, error=None):
+    """Change the state of an upload job (called in a write transaction)."""
+    job.state = state
+    job.last_error = error
+    job.updated = datetime.now()
+    job.save()
+
+
+def _commit(result, counts):
+    """Record the result of an upload in the database.
+
+    Arguments:
+    result -- the result of _upload_job
+    counts -- dict counting the uploads per final state
+    """
+    if result is None:
         return
-    identifier, files, metadata, dbobj = params
+    task, identifier, error = result
+    job, document, files, metadata = task
+    with write_transaction():
+        if error is None:
+            print "DEBUG: Successfully uploaded", identifier
+            document.archive_ident = identifier
+            document.save()
+            _set_state(job, UPLOAD_DONE)
+        else:
+            print "ERROR: Upload of", job.identifier, "failed:", error
+            _set_state(job, UPLOAD_FAILED, error)
+    counts[job.state] += 1
+
+
+def _upload_job(task):
+    """Helper function to upload a document in a worker thread.
+
+    Duplicates of documents that have already been uploaded are not uploaded
+    again, but get the identifier of the original, as long as the files still
+    have the same content.
+
+    Returns a tuple (task, identifier, error), where error is None on
+    success.
+    """
+    job, document, files, metadata = task
+    if (document.duplicate_of is not None and
+            manifest.original(document.path) == document.duplicate_of):
+        identifier = _original_identifier(document.duplicate_of)
+        if identifier is not None:
+            return (task, identifier, None)
+    with write_transaction():
+        job.attempts += 1
+        _set_state(job, UPLOAD_IN_FLIGHT)
     try:
-        r = upload(identifier, files=files, metadata=metadata, verify=True, retries=5)
+        # Use the digests computed during the download, unless the file has
+        # changed since, and let the server verify the upload with them
+        document.sha256, document.md5 = manifest.digests(document.path)
+        if document.md5 is not None:
+            r = upload(job.identifier, files=files, metadata=metadata, retries=5,
+                       headers={'Content-MD5': document.md5}, verify=False)
+        else:
+            r = upload(job.identifier, files=files, metadata=metadata, verify=True, retries=5)
     except Exception as e:
-        print "ERROR: Received exception, stopping upload attempt"
-        print e
-        return None
+        return (task, None, "%s: %s" % (type(e).__name__, e))
     if r[0].status_code != 200:
-        print "ERROR: Upload of", identifier, "failed:", r[0].status_code
-        return None
-    else:
-        print "DEBUG: Uploaded", identifier
-        return (dbobj, identifier)
+        return (task, None, "status code %d" % r[0].status_code)
+    print "DEBUG: Uploaded", job.identifier
+    return (task, job.identifier, None)
+
+
+def _original_identifier(path):
+    """Get the archive identifier of the uploaded document with a file."""
+    for model in (Plenarprotokoll, Drucksache):
+        query = model.select(model.archive_ident).where(
+            (model.path == path) & model.archive_ident.is_null(False)).tuples()
+        for (identifier, ) in query:
+            return identifier
+    return None
 
 
 # metadata = dict(collection='test_collection',  # TODO Update
@@ -0,0 +1,31 @@
+"""pdok-mirror - convert all downloaded PDFs that lack a text version.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from util import convert
+import argparse
+
+parser = argparse.ArgumentParser(description="Convert all PDFs without text version.")
+parser.add_argument("root", nargs="?", default="documents",
+                    help="directory containing the PDFs (default: documents)")
+parser.add_argument("--workers", type=int, default=convert.CONVERT_WORKERS,
+                    help="number of parallel pdftotext processes")
+parser.add_argument("--timeout", type=int, default=convert.CONVERT_TIMEOUT,
+                    help="seconds after which a single conversion is aborted")
+args = parser.parse_args()
+
+convert.convert_missing(args.root, args.workers, args.timeout)
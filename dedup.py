@@ -0,0 +1,31 @@
+"""pdok-mirror - replace duplicate documents by hardlinks.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from util import dedup, manifest
+import argparse
+
+parser = argparse.ArgumentParser(description="Replace identical PDFs (and their text versions) by hardlinks.")
+parser.add_argument("root", nargs="?", default="documents",
+                    help="directory containing the PDFs (default: documents)")
+parser.add_argument("--workers", type=int, default=manifest.REBUILD_WORKERS,
+                    help="number of threads hashing new or changed files")
+args = parser.parse_args()
+
+# Duplicates are found by their recorded digests
+manifest.rebuild(args.root, args.workers)
+dedup.deduplicate_tree(args.root)
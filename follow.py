@@ -0,0 +1,28 @@
+"""pdok-mirror - pick up new documents of the open period (e.g. from cron).
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from controller import scraper
+import argparse
+
+parser = argparse.ArgumentParser(description="Download new documents of the open period.")
+parser.add_argument("period", type=int, help="number of the open period")
+parser.add_argument("--deep", action="store_true",
+                    help="re-check all numbers of the period, not just new ones")
+args = parser.parse_args()
+
+scraper.follow_period(args.period, args.deep)
@@ -17,10 +17,40 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
+import threading
 
 
-db = SqliteDatabase('pdoc.sqlite', threadlocals=True)
+# Number of documents written per transaction by the bulk path
+BATCH_SIZE = 500
+# Maximum number of bound variables in a single SQLite statement
+SQLITE_MAX_VARIABLES = 999
+
+# Name of the FTS5 table of the full-text index, and whether it is available
+FULLTEXT_TABLE = "document_text"
+fulltext_available = False
+
+# States of an UploadJob
+UPLOAD_PENDING = "pending"
+UPLOAD_IN_FLIGHT = "in-flight"
+UPLOAD_DONE = "done"
+UPLOAD_FAILED = "failed"
+
+# Use write-ahead logging, so the scraper can read while the writer thread is
+# inserting, and only sync to disk at checkpoints instead of every commit
+db = SqliteDatabase('pdoc.sqlite', threadlocals=True,
+                    pragmas=(('journal_mode', 'wal'),
+                             ('synchronous', 'normal'),
+                             ('cache_size', -32000),
+                             ('temp_store', 'memory')))
+
+# SQLite only allows one writer at a time, so writes are serialized here
+# instead of failing with "database is locked" when several periods are
+# scraped at once
+_write_lock = threading.RLock()
 
 
 class Wahlperiode(Model):
@@ -62,11 +92,21 @@ class Document(Model):
     title = CharField()
     # Veröffentlichungsdatum
     date = DateTimeField()
-    # Path to the file
-    path = CharField()
+    # Path to the file (indexed, as documents are looked up by their file)
+    path = CharField(index=True)
     # Source URL
     source = CharField()
 
+    # HTTP validators of the downloaded version, for conditional refreshes
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+    content_length = IntegerField(null=True)
+    # Digests of the downloaded version, computed during the download
+    sha256 = CharField(null=True)
+    md5 = CharField(null=True)
+    # Path of the file of an identical document, if this is a duplicate
+    duplicate_of = CharField(null=True)
+
     class Meta:
         """Meta information about model."""
 
@@ -94,9 +134,306 @@ class Plenarprotokoll(Document):
     pass
 
 
+class FileManifest(Model):
+    """Known state of a downloaded file, to avoid re-validating it."""
+
+    # Path to the file
+    path = CharField(primary_key=True)
+    # Size and modification time at the time of validation
+    size = IntegerField()
+    mtime = FloatField()
+    # Whether the file is a valid PDF
+    valid = BooleanField()
+    # SHA-256 and MD5 digests of the file contents
+    sha256 = CharField(null=True)
+    md5 = CharField(null=True)
+    # HTTP validators of the downloaded version, if known
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+
+    class Meta:
+        """Meta information about model."""
+
+        database = db
+
+
+class MissingDocument(Model):
+    """Document number that was probed and found missing."""
+
+    # Wahlperiode the number was probed in
+    period = ForeignKeyField(Wahlperiode, related_name='missing_documents')
+    # Type of the document (Drucksache or Plenarprotokoll)
+    doctype = CharField()
+    # The missing document number
+    number = IntegerField()
+    # Time of the last probe, and seconds until the number should be re-probed
+    checked = DateTimeField()
+    ttl = IntegerField()
+
+    class Meta:
+        """Meta information about model."""
+
+        database = db
+        indexes = ((('period', 'doctype', 'number'), True), )
+
+
+class IndexedText(Model):
+    """Text file of a document that has been added to the full-text index."""
+
+    # Path to the text file
+    path = CharField(primary_key=True)
+    # Type and database identifier of the document
+    doctype = CharField()
+    document = IntegerField()
+    # Size and modification time of the text file when it was indexed
+    size = IntegerField()
+    mtime = FloatField()
+    # Row of the document in the full-text index
+    fulltext_row = IntegerField()
+
+    class Meta:
+        """Meta information about model."""
+
+        database = db
+
+
+class UploadJob(Model):
+    """Upload of a document to the Internet Archive.
+
+    Jobs are committed one by one as they complete, so an interrupted upload
+    run can be resumed where it stopped.
+    """
+
+    # Internet Archive identifier of the item
+    identifier = CharField(primary_key=True)
+    # Wahlperiode and type of the document
+    period = ForeignKeyField(Wahlperiode, related_name='upload_jobs')
+    doctype = CharField()
+    # Database identifier of the document
+    document = IntegerField()
+    # One of UPLOAD_PENDING, UPLOAD_IN_FLIGHT, UPLOAD_DONE and UPLOAD_FAILED
+    state = CharField(default=UPLOAD_PENDING)
+    # Number of upload attempts, and the error of the last failed attempt
+    attempts = IntegerField(default=0)
+    last_error = TextField(null=True)
+    # Time of the last state change
+    updated = DateTimeField(default=datetime.now)
+
+    class Meta:
+        """Meta information about model."""
+
+        database = db
+        indexes = ((('period', 'doctype', 'state'), False), )
+
+
+def known_docnos(model, period):
+    """Get the document numbers of a period that are already in the database.
+
+    Arguments:
+    model  -- the document model (Drucksache or Plenarprotokoll)
+    period -- the Wahlperiode to load the document numbers for
+
+    Returns a set of document numbers, loaded in a single query.
+    """
+    query = model.select(model.docno).where(model.period == period).tuples()
+    return set(docno for (docno, ) in query)
+
+
+@contextmanager
+def write_transaction():
+    """Context manager for a write transaction, serialized across threads."""
+    with _write_lock:
+        with db.atomic():
+            yield
+
+
+def insert_documents(model, rows):
+    """Insert many new documents at once, in a single transaction.
+
+    Arguments:
+    model -- the document model (Drucksache or Plenarprotokoll)
+    rows  -- a list of dicts mapping field names to values
+    """
+    if len(rows) == 0:
+        return
+    # Split into statements that stay below the SQLite variable limit
+    chunk_size = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+    with write_transaction():
+        for i in range(0, len(rows), chunk_size):
+            model.insert_many(rows[i:i + chunk_size]).execute()
+
+
+def recently_missing(period, doctype):
+    """Get the numbers of a period that were recently confirmed missing.
+
+    Arguments:
+    period  -- the Wahlperiode to load the numbers for
+    doctype -- the type of document (Drucksache or Plenarprotokoll)
+
+    Returns a set of numbers whose TTL has not expired yet.
+    """
+    now = datetime.now()
+    query = (MissingDocument
+             .select(MissingDocument.number, MissingDocument.checked, MissingDocument.ttl)
+             .where((MissingDocument.period == period) &
+                    (MissingDocument.doctype == doctype))
+             .tuples())
+    return set(number for number, checked, ttl in query
+               if checked + timedelta(seconds=ttl) > now)
+
+
+def record_missing(period, doctype, numbers, ttl, max_ttl):
+    """Record document numbers that were probed and found missing.
+
+    Numbers that were already known to be missing get their TTL doubled (up
+    to max_ttl), so gaps that stay empty are re-probed less and less often.
+
+    Arguments:
+    period  -- the Wahlperiode the numbers were probed in
+    doctype -- the type of document (Drucksache or Plenarprotokoll)
+    numbers -- the missing numbers
+    ttl     -- seconds until newly missing numbers should be re-probed
+    max_ttl -- maximum number of seconds between two probes
+    """
+    previous = dict((MissingDocument
+                     .select(MissingDocument.number, MissingDocument.ttl)
+                     .where((MissingDocument.period == period) &
+                            (MissingDocument.doctype == doctype))
+                     .tuples()))
+    now = datetime.now()
+    rows = [dict(period=period.dbid, doctype=doctype, number=number, checked=now,
+                 ttl=min(previous[number] * 2, max_ttl) if number in previous else ttl)
+            for number in numbers]
+    if len(rows) == 0:
+        return
+    chunk_size = SQLITE_MAX_VARIABLES // len(rows[0])
+    with write_transaction():
+        for i in range(0, len(rows), chunk_size):
+            MissingDocument.insert_many(rows[i:i + chunk_size]).upsert().execute()
+
+
+def clear_missing(period, doctype, numbers, above=None):
+    """Forget document numbers that have turned up after all.
+
+    Arguments:
+    period  -- the Wahlperiode the numbers belong to
+    doctype -- the type of document (Drucksache or Plenarprotokoll)
+    numbers -- the numbers that exist now
+    above   -- also forget all numbers greater than this one, or None
+    """
+    numbers = list(numbers)
+    with write_transaction():
+        if above is not None:
+            (MissingDocument.delete()
+             .where((MissingDocument.period == period) &
+                    (MissingDocument.doctype == doctype) &
+                    (MissingDocument.number > above))
+             .execute())
+        for i in range(0, len(numbers), SQLITE_MAX_VARIABLES - 2):
+            (MissingDocument.delete()
+             .where((MissingDocument.period == period) &
+                    (MissingDocument.doctype == doctype) &
+                    (MissingDocument.number << numbers[i:i + SQLITE_MAX_VARIABLES - 2]))
+             .execute())
+
+
+def mark_duplicates(originals):
+    """Flag documents whose files are duplicates of other documents.
+
+    Arguments:
+    originals -- dict mapping the paths of the duplicates to the paths of
+                 their originals
+    """
+    paths = sorted(originals)
+    for i in range(0, len(paths), BATCH_SIZE):
+        with write_transaction():
+            for path in paths[i:i + BATCH_SIZE]:
+                for model in (Plenarprotokoll, Drucksache):
+                    model.update(duplicate_of=originals[path]).where(model.path == path).execute()
+
+
+def add_upload_jobs(rows, states=(UPLOAD_DONE,)):
+    """Add upload jobs for documents that need to be uploaded.
+
+    Documents that already have a job keep it, unless it is in one of the
+    given states (by default, done): then the document needs to be uploaded
+    again, so the job is reset to pending, with its attempts cleared.
+
+    Arguments:
+    rows   -- a list of dicts mapping UploadJob field names to values
+    states -- the states of existing jobs that are reset to pending
+    """
+    if len(rows) == 0:
+        return
+    chunk_size = SQLITE_MAX_VARIABLES // len(rows[0])
+    identifiers = [row['identifier'] for row in rows]
+    with write_transaction():
+        for i in range(0, len(rows), chunk_size):
+            UploadJob.insert_many(rows[i:i + chunk_size]).on_conflict('IGNORE').execute()
+        chunk_size = SQLITE_MAX_VARIABLES - 5 - len(states)
+        for i in range(0, len(identifiers), chunk_size):
+            (UploadJob.update(state=UPLOAD_PENDING, attempts=0, last_error=None,
+                              updated=datetime.now())
+             .where((UploadJob.identifier << identifiers[i:i + chunk_size]) &
+                    (UploadJob.state << list(states)))
+             .execute())
+
+
+def add_missing_columns(model):
+    """Add columns introduced after the table of a model was created.
+
+    New fields must be nullable or have a default value.
+    """
+    existing = set(column.name for column in db.get_columns(model._meta.db_table))
+    migrator = SqliteMigrator(db)
+    operations = [migrator.add_column(model._meta.db_table, field.db_column, field)
+                  for field in model._meta.sorted_fields
+                  if field.db_column not in existing]
+    if len(operations) > 0:
+        migrate(*operations)
+
+
+def add_missing_indexes(model):
+    """Create the indexes of fields that were indexed after the table of a
+    model was created.
+    """
+    table = model._meta.db_table
+    existing = set(tuple(index.columns) for index in db.get_indexes(table))
+    migrator = SqliteMigrator(db)
+    operations = [migrator.add_index(table, [field.db_column], field.unique)
+                  for field in model._meta.sorted_fields
+                  if (field.index or field.unique) and not field.primary_key and
+                  (field.db_column, ) not in existing]
+    if len(operations) > 0:
+        migrate(*operations)
+
+
+def create_fulltext_table():
+    """Create the FTS5 table of the full-text index, if SQLite supports it.
+
+    The table is not a peewee model, as peewee can not create virtual tables
+    on a plain SqliteDatabase.  Returns whether the table is available.
+    """
+    try:
+        db.execute_sql("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+                       "title, body, docno UNINDEXED, doctype UNINDEXED, document UNINDEXED)"
+                       % FULLTEXT_TABLE)
+    except OperationalError as e:
+        print "WARN: Full-text index not available:", e
+        return False
+    return True
+
+
 def setup():
     """Set up the database connection."""
+    global fulltext_available
+    models = [Wahlperiode, Document, Drucksache, Plenarprotokoll, FileManifest,
+              MissingDocument, UploadJob, IndexedText]
     db.connect()
-    db.create_tables([Wahlperiode, Document, Drucksache, Plenarprotokoll], safe=True)
+    db.create_tables(models, safe=True)
+    for model in models:
+        add_missing_columns(model)
+        add_missing_indexes(model)
+    fulltext_available = create_fulltext_table()
 
 setup()
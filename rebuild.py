@@ -0,0 +1,32 @@
+"""pdok-mirror - rebuild the database from the downloaded documents.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from controller import scraper
+from util import cache
+import argparse
+
+parser = argparse.ArgumentParser(description="Rebuild the database entries of periods from the documents directory.")
+parser.add_argument("periods", metavar="period", type=int, nargs="+",
+                    help="number of a period to rebuild")
+parser.add_argument("--offline", action="store_true",
+                    help="only use cached metadata, never access the network")
+args = parser.parse_args()
+
+cache.set_offline(args.offline)
+for period_no_numeric in args.periods:
+    scraper.rebuild_period(period_no_numeric)
@@ -0,0 +1,28 @@
+"""pdok-mirror - check mirrored documents for new versions.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from controller import refresher
+import argparse
+
+parser = argparse.ArgumentParser(description="Check mirrored documents for new versions.")
+parser.add_argument("periods", metavar="period", type=int, nargs="+",
+                    help="number of a period to refresh")
+args = parser.parse_args()
+
+for period_no_numeric in args.periods:
+    refresher.refresh_period(period_no_numeric)
@@ -0,0 +1,29 @@
+"""pdok-mirror - search the full-text index.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from util import fulltext
+import argparse
+
+parser = argparse.ArgumentParser(description="Search the text of the mirrored documents.")
+parser.add_argument("query", help="FTS5 query, e.g. Bundesversammlung or '\"Kleine Anfrage\" AND Bahn'")
+parser.add_argument("--limit", type=int, default=fulltext.SEARCH_LIMIT,
+                    help="maximum number of results")
+args = parser.parse_args()
+
+for docno, doctype, dbid, snippet in fulltext.search(args.query.decode("utf-8"), args.limit):
+    print (u"%s %s: %s" % (doctype, docno, u" ".join(snippet.split()))).encode("utf-8")
@@ -16,13 +16,11 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from controller import scraper, uploader
+from controller import scheduler
 
 max_period = 18
 
-for i in range(1, 19, 1):
-    scraper.scrape_period(i, max_period)
-    uploader.upload_legislaturperiode(i)
+scheduler.run_periods(range(1, max_period + 1), max_period)
 
 
 # max_period = 18
@@ -0,0 +1,150 @@
+# -*- encoding: utf-8 -*-
+"""On-disk cache for HTML pages (i.e. the pdok metadata).
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from .util import get_html
+import hashlib
+import io
+import os
+import threading
+import time
+
+
+# Directory holding the cached pages
+CACHE_DIR = "cache"
+# Seconds after which a cached page is fetched again
+CACHE_TTL = 30 * 24 * 60 * 60
+# Maximum size of the cache in bytes.  When it is exceeded, the least
+# recently used pages are evicted until it is back below 90% of this.
+CACHE_MAX_SIZE = 512 * 1024 * 1024
+
+# Only serve pages from the cache, never touch the network
+_offline = False
+# Current size of the cache in bytes, determined on first use
+_size = None
+_lock = threading.Lock()
+
+
+def set_offline(offline):
+    """Switch the offline mode on or off.
+
+    In offline mode, cached_html only returns cached pages (regardless of
+    their age), and None for everything else.
+    """
+    global _offline
+    _offline = offline
+
+
+def cached_html(url, ttl=CACHE_TTL, wait=True):
+    """Get the HTML behind an URL, using the cache if possible.
+
+    Arguments:
+    url  -- the URL as a string
+    ttl  -- seconds after which a cached copy is considered stale
+    wait -- retry failed requests, sleeping in between (see util.get_html)
+
+    Returns the HTML as a unicode string, or None if it could not be fetched.
+    """
+    path = _path(url)
+    if os.path.isfile(path):
+        age = time.time() - os.path.getmtime(path)
+        if _offline or age < ttl:
+            # Mark as recently used for the eviction, keeping the age intact
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+            with io.open(path, encoding="utf-8") as fi:
+                return fi.read()
+    if _offline:
+        return None
+
+    html = get_html(url, wait=wait)
+    if html is not None:
+        _store(path, html)
+    return html
+
+
+def invalidate(url):
+    """Remove a page from the cache (e.g. because it could not be parsed)."""
+    path = _path(url)
+    if os.path.isfile(path):
+        size = os.path.getsize(path)
+        os.remove(path)
+        _account(-size)
+
+
+def _path(url):
+    """Get the cache path for an URL."""
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, key[:2], key + ".html")
+
+
+def _store(path, html):
+    """Write a page to the cache, evicting old pages if necessary."""
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # Created by another thread in the meantime
+            pass
+    temp = "%s.%d.tmp" % (path, threading.current_thread().ident)
+    with io.open(temp, "w", encoding="utf-8") as fo:
+        fo.write(html)
+    # A stale copy being replaced no longer counts towards the size
+    try:
+        replaced = os.path.getsize(path)
+    except OSError:
+        replaced = 0
+    os.rename(temp, path)
+    _account(os.path.getsize(path) - replaced)
+
+
+def _account(delta):
+    """Update the cache size, and evict pages if it grew too large."""
+    global _size
+    with _lock:
+        if _size is None:
+            _size = sum(entry[2] for entry in _entries())
+        else:
+            _size += delta
+        if _size > CACHE_MAX_SIZE:
+            _evict()
+
+
+def _evict():
+    """Remove the least recently used pages (called with the lock held)."""
+    global _size
+    # Sort by access time, which cached_html updates on every hit
+    for path, atime, size in sorted(_entries(), key=lambda entry: entry[1]):
+        if _size <= CACHE_MAX_SIZE * 0.9:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        _size -= size
+
+
+def _entries():
+    """List all cached pages as (path, access time, size) tuples."""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(CACHE_DIR):
+        for filename in filenames:
+            if filename.endswith(".html"):
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                entries.append((path, stat.st_atime, stat.st_size))
+    return entries
@@ -0,0 +1,324 @@
+# -*- encoding: utf-8 -*-
+"""Conversion of the downloaded PDFs to text files.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from . import manifest
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+
+# Number of pdftotext processes running in parallel
+CONVERT_WORKERS = 4
+# Seconds after which a pdftotext process is killed
+CONVERT_TIMEOUT = 300
+# Suffix of the marker files recording failed conversions.  Files with such a
+# marker are not retried, delete the marker to try again.
+FAILED_SUFFIX = ".txt.failed"
+# PDFs with more pages than this are split into page ranges, which are
+# converted in parallel and stitched back together afterwards
+SPLIT_PAGE_THRESHOLD = 150
+# Number of pages per range of a split conversion
+SPLIT_PAGES = 50
+# Maximum number of pdftotext processes running at the same time, across
+# all conversions (e.g. of several periods scraped at once)
+PROCESS_LIMIT = cpu_count()
+
+_process_slots = threading.BoundedSemaphore(PROCESS_LIMIT)
+
+
+class Throughput(object):
+    """Thread-safe statistics on converted files."""
+
+    def __init__(self):
+        """Start measuring."""
+        self.start = time.time()
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        """Count a converted file with the given size in bytes."""
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+    def fail(self):
+        """Count a failed conversion."""
+        with self._lock:
+            self.failed += 1
+
+    def report(self):
+        """Print the statistics."""
+        elapsed = max(time.time() - self.start, 0.001)
+        print "INFO: Converted %d files in %.1fs (%.1f files/s, %.2f MB/s), %d failed" % (
+            self.files, elapsed, self.files / elapsed,
+            self.bytes / elapsed / 1024 / 1024, self.failed)
+
+
+def pdf_to_text(files, workers=CONVERT_WORKERS, timeout=CONVERT_TIMEOUT):
+    """Convert a number of PDFs to text files using pdftotext.
+
+    Arguments:
+    files   -- a List of files (as paths) to convert
+    workers -- number of conversions to run in parallel
+    timeout -- seconds after which a single conversion is aborted
+    """
+    # Ensure pdftotext is installed
+    if not pdftotext_available():
+        print "WARN: Please install pdftotext to enable automatic conversion to text files"
+        return
+
+    # pdftotext is installed - Process files
+    stats = Throughput()
+    pool = ThreadPool(processes=workers)
+    for _ in pool.imap_unordered(lambda file: convert_pdf(file, timeout, stats), files):
+        pass
+    pool.close()
+    pool.join()
+    stats.report()
+
+
+def convert_missing(root="documents", workers=CONVERT_WORKERS, timeout=CONVERT_TIMEOUT):
+    """Convert all PDFs below a directory that have no text file yet.
+
+    Arguments:
+    root    -- the directory to search for PDFs
+    workers -- number of conversions to run in parallel
+    timeout -- seconds after which a single conversion is aborted
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(".pdf") and needs_conversion(os.path.join(dirpath, filename)):
+                files.append(os.path.join(dirpath, filename))
+    print "INFO: Found", len(files), "files without text version"
+    pdf_to_text(sorted(files), workers, timeout)
+
+
+def pdftotext_available():
+    """Check if pdftotext is installed."""
+    with open(os.devnull, "w") as devnull:
+        try:
+            subprocess.Popen(["pdftotext"], stdout=devnull, stderr=devnull).communicate()
+        except OSError as e:
+            if e.errno == os.errno.ENOENT:
+                return False
+            else:
+                raise e
+    return True
+
+
+def needs_conversion(file):
+    """Check if a PDF has neither been converted nor failed to convert."""
+    return not (os.path.isfile(file[:-4] + ".txt") or
+                os.path.isfile(file[:-4] + FAILED_SUFFIX))
+
+
+def convert_pdf(file, timeout=CONVERT_TIMEOUT, stats=None):
+    """Convert a single PDF to a text file, if it has not been converted yet.
+
+    Failed conversions (including timeouts) are recorded in a marker file next
+    to the PDF, so they are not retried on every run.
+
+    Arguments:
+    file    -- path to the PDF file, or None (which is ignored)
+    timeout -- seconds after which the conversion is aborted
+    stats   -- a Throughput object to count the conversion in, or None
+
+    Returns True if the file was converted, False if not.
+    """
+    if file is None or not needs_conversion(file):
+        return False
+
+    # Identical documents share the text version of the original
+    # (imported here, as util.dedup uses this module)
+    from .dedup import link_text
+    original = manifest.original(file)
+    if original is not None and link_text(original, file):
+        return True
+
+    pages = page_count(file, timeout)
+    if pages is not None and pages > SPLIT_PAGE_THRESHOLD:
+        error = convert_split(file, pages, timeout)
+    else:
+        error = convert_whole(file, timeout)
+    if error is not None:
+        print "WARN: Converting", file, "to text failed:", error
+        if os.path.isfile(file[:-4] + ".txt"):
+            os.remove(file[:-4] + ".txt")
+        with open(file[:-4] + FAILED_SUFFIX, "w") as fo:
+            fo.write(error + "\n")
+        if stats is not None:
+            stats.fail()
+        return False
+
+    if stats is not None:
+        stats.add(os.path.getsize(file))
+    return True
+
+
+def convert_whole(file, timeout=CONVERT_TIMEOUT):
+    """Convert a PDF at once.
+
+    The text is written to a temporary file, and only moved to its final place
+    once it is complete, so a half-written text file is never hardlinked to
+    the duplicates of the PDF.
+
+    Arguments:
+    file    -- path to the PDF file
+    timeout -- seconds after which the conversion is aborted
+
+    Returns None on success, or a description of the error.
+    """
+    base = file[:-4]
+    try:
+        error = run_pdftotext(["pdftotext", "-layout", file, base + ".txt.tmp"], timeout)
+        if error is None:
+            os.rename(base + ".txt.tmp", base + ".txt")
+        return error
+    finally:
+        if os.path.isfile(base + ".txt.tmp"):
+            os.remove(base + ".txt.tmp")
+
+
+def convert_split(file, pages, timeout=CONVERT_TIMEOUT):
+    """Convert a large PDF in page ranges that are processed in parallel.
+
+    pdftotext terminates every page with a form feed, independently of the
+    other pages, so concatenating the text of consecutive page ranges gives
+    the same bytes as converting the whole file at once.
+
+    Arguments:
+    file    -- path to the PDF file
+    pages   -- number of pages of the PDF file
+    timeout -- seconds after which the conversion of a page range is aborted
+
+    Returns None on success, or a description of the error.
+    """
+    base = file[:-4]
+    ranges = [(first, min(first + SPLIT_PAGES - 1, pages))
+              for first in range(1, pages + 1, SPLIT_PAGES)]
+    parts = ["%s.%d-%d.txt.part" % (base, first, last) for first, last in ranges]
+
+    def convert_range(i):
+        first, last = ranges[i]
+        return run_pdftotext(["pdftotext", "-layout", "-f", str(first), "-l", str(last),
+                              file, parts[i]], timeout)
+
+    pool = ThreadPool(processes=min(len(ranges), CONVERT_WORKERS))
+    try:
+        errors = pool.map(convert_range, range(len(ranges)))
+        pool.close()
+        pool.join()
+        for error in errors:
+            if error is not None:
+                return error
+
+        # Stitch the parts together, and only move the result to its final
+        # place once it is complete
+        with open(base + ".txt.tmp", "wb") as fo:
+            for part in parts:
+                with open(part, "rb") as fi:
+                    shutil.copyfileobj(fi, fo)
+        os.rename(base + ".txt.tmp", base + ".txt")
+        return None
+    finally:
+        for part in parts:
+            if os.path.isfile(part):
+                os.remove(part)
+
+
+def page_count(file, timeout=CONVERT_TIMEOUT):
+    """Get the number of pages of a PDF using pdfinfo.
+
+    Arguments:
+    file    -- path to the PDF file
+    timeout -- seconds after which pdfinfo is killed
+
+    Returns the number of pages, or None if it could not be determined.
+    """
+    try:
+        error, output = run_process(["pdfinfo", file], timeout, capture=True)
+    except OSError:
+        # pdfinfo is not installed
+        return None
+    match = re.search(r"^Pages:\s+(\d+)", output, re.MULTILINE)
+    if error is not None or match is None:
+        return None
+    return int(match.group(1))
+
+
+def run_pdftotext(args, timeout=CONVERT_TIMEOUT):
+    """Run a pdftotext command, killing it if it takes too long.
+
+    Arguments:
+    args    -- the command line to run
+    timeout -- seconds after which the process is killed
+
+    Returns None on success, or a description of the error.
+    """
+    return run_process(args, timeout)[0]
+
+
+def run_process(args, timeout=CONVERT_TIMEOUT, capture=False):
+    """Run a poppler command, killing it if it takes too long.
+
+    The number of processes running at the same time is limited to
+    PROCESS_LIMIT.
+
+    Arguments:
+    args    -- the command line to run
+    timeout -- seconds after which the process is killed
+    capture -- return the output of the process (otherwise, it is discarded)
+
+    Returns a tuple (error, output), where error is None on success, or a
+    description of the error, and output is the output of the process (or
+    None).  Raises OSError if the command is not installed.
+    """
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            proc.kill()
+        except OSError:
+            # Process has exited in the meantime
+            pass
+
+    with _process_slots, open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE if capture else devnull,
+                                stderr=devnull)
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            output = proc.communicate()[0]
+        finally:
+            timer.cancel()
+
+    if timed_out.is_set():
+        return ("timeout after %d seconds" % timeout, output)
+    if proc.returncode != 0:
+        return ("%s exited with status %d" % (args[0], proc.returncode), output)
+    return (None, output)
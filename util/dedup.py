@@ -0,0 +1,114 @@
+# -*- encoding: utf-8 -*-
+"""Deduplication of identical documents with hardlinks.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from . import manifest
+from .convert import FAILED_SUFFIX
+from models.database import mark_duplicates
+import os
+
+
+# Suffix of the temporary links, which are renamed over the duplicates
+LINK_SUFFIX = ".link"
+
+
+def deduplicate(path):
+    """Replace a file by a hardlink to its original, if it has one.
+
+    The text version of the original is linked as well, so the duplicate
+    does not need to be converted.
+
+    Arguments:
+    path -- path to the file, or None (which is ignored)
+
+    Returns the path, so this can be chained with download functions.
+    """
+    if path is None:
+        return None
+    original = manifest.original(path)
+    if original is not None:
+        link(original, path)
+        link_text(original, path)
+    return path
+
+
+def deduplicate_tree(root="documents"):
+    """Hardlink all duplicate files below a directory to their originals.
+
+    The duplicates are flagged in the database.  The manifest should be up
+    to date (see manifest.rebuild), as the files are compared by their
+    recorded digests.
+
+    Arguments:
+    root -- the directory to deduplicate
+    """
+    originals = {}
+    saved = 0
+    for group in manifest.duplicates(root):
+        original = group[0]
+        for path in group[1:]:
+            originals[path] = original
+            if link(original, path):
+                saved += os.path.getsize(path)
+            link_text(original, path)
+    mark_duplicates(originals)
+    print "INFO: Found", len(originals), "duplicates, saved", saved // (1024 * 1024), "MB"
+
+
+def link(original, path):
+    """Replace a file by a hardlink to another file.
+
+    The manifest entry of the file is updated with the digests of the
+    original (which are the same), so it is not hashed again.
+
+    Arguments:
+    original -- path to the file to link to
+    path     -- path to the file to replace
+
+    Returns True if the file was replaced, False if it already was a link to
+    the original.
+    """
+    if os.path.exists(path) and os.path.samefile(original, path):
+        return False
+    temp = path + LINK_SUFFIX
+    if os.path.exists(temp):
+        os.remove(temp)
+    os.link(original, temp)
+    os.rename(temp, path)
+    if path.endswith(".pdf"):
+        entry = manifest.lookup(original)
+        manifest.update(path, sha256=entry.sha256, valid=entry.valid, md5=entry.md5)
+    return True
+
+
+def link_text(original, path):
+    """Link the text version of an original PDF to a duplicate.
+
+    Arguments:
+    original -- path to the original PDF
+    path     -- path to the duplicate PDF
+
+    Returns True if the duplicate has the text version of the original now.
+    """
+    text = original[:-4] + ".txt"
+    if not os.path.isfile(text):
+        return False
+    link(text, path[:-4] + ".txt")
+    if os.path.isfile(path[:-4] + FAILED_SUFFIX):
+        os.remove(path[:-4] + FAILED_SUFFIX)
+    return True
@@ -0,0 +1,181 @@
+# -*- encoding: utf-8 -*-
+"""Full-text index over the text versions of the documents.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from models import database
+from models.database import FULLTEXT_TABLE, Drucksache, IndexedText, Plenarprotokoll, db, write_transaction
+import io
+import os
+import threading
+
+
+# Number of documents added to the index per transaction
+INDEX_BATCH_SIZE = 100
+# Number of results returned by a search, and the number of words around
+# the matches shown in the snippets
+SEARCH_LIMIT = 20
+SNIPPET_WORDS = 16
+# Weight of a match in the title, relative to a match in the text
+TITLE_WEIGHT = 10.0
+
+
+class Indexer(object):
+    """Batching writer adding converted documents to the full-text index.
+
+    Documents can be converted before the database writer has inserted them,
+    so files whose document is not in the database yet are set aside, and
+    only retried once the writer has written another batch (see
+    documents_written).  Call flush after all documents have been written.
+    """
+
+    def __init__(self, model):
+        """Create a new indexer.
+
+        Arguments:
+        model -- the document model (Drucksache or Plenarprotokoll)
+        """
+        self.model = model
+        self.paths = []
+        # Files whose document was not in the database yet, and whether
+        # documents have been written since they were last tried
+        self.pending = []
+        self.written = False
+        self._lock = threading.Lock()
+
+    def add(self, path):
+        """Queue the PDF file of a converted document (None is ignored)."""
+        if path is None or not database.fulltext_available:
+            return
+        with self._lock:
+            self.paths.append(path)
+            if self.written and len(self.pending) > 0:
+                self.pending = index_files(self.model, self.pending)
+            self.written = False
+            if len(self.paths) >= INDEX_BATCH_SIZE:
+                self.pending.extend(index_files(self.model, self.paths))
+                self.paths = []
+
+    def documents_written(self):
+        """Note that documents were written, so the set aside files are
+        retried with the next file added.
+        """
+        with self._lock:
+            self.written = True
+
+    def flush(self):
+        """Index all queued files, dropping those without a document."""
+        if not database.fulltext_available:
+            return
+        with self._lock:
+            index_files(self.model, self.pending + self.paths)
+            self.paths = []
+            self.pending = []
+            self.written = False
+
+
+def update_index():
+    """Bring the full-text index up to date with all converted documents.
+
+    Only new and changed text files are read, so this is cheap to run
+    repeatedly.
+    """
+    if not database.fulltext_available:
+        return
+    for model in (Plenarprotokoll, Drucksache):
+        indexer = Indexer(model)
+        for (path, ) in model.select(model.path).tuples().iterator():
+            indexer.add(path)
+        indexer.flush()
+
+
+def index_files(model, paths):
+    """Add the text versions of some documents to the index.
+
+    Text files that have not changed since they were indexed are skipped,
+    changed ones are replaced in the index, and deleted ones are removed.
+
+    Arguments:
+    model -- the document model (Drucksache or Plenarprotokoll)
+    paths -- paths to the PDF files of the documents
+
+    Returns the paths whose documents are not in the database (yet).
+    """
+    if len(paths) == 0:
+        return []
+    doctype = model.__name__
+    documents = {}
+    for i in range(0, len(paths), database.SQLITE_MAX_VARIABLES):
+        query = (model.select(model.dbid, model.docno, model.title, model.path)
+                 .where(model.path << paths[i:i + database.SQLITE_MAX_VARIABLES])
+                 .tuples())
+        for dbid, docno, title, path in query:
+            documents[path] = (dbid, docno, title)
+    texts = [path[:-4] + ".txt" for path in documents]
+    indexed = dict((entry.path, entry) for entry in
+                   IndexedText.select().where(IndexedText.path << texts)) if texts else {}
+
+    # Read the new and changed texts before starting the transaction
+    changes = []
+    for path, (dbid, docno, title) in documents.items():
+        text = path[:-4] + ".txt"
+        entry = indexed.get(text)
+        if not os.path.isfile(text):
+            if entry is not None:
+                changes.append((entry, None, None))
+            continue
+        stat = os.stat(text)
+        if entry is not None and entry.size == stat.st_size and entry.mtime == stat.st_mtime:
+            continue
+        with io.open(text, encoding="utf-8", errors="replace") as fi:
+            body = fi.read()
+        changes.append((entry, IndexedText(path=text, doctype=doctype, document=dbid,
+                                           size=stat.st_size, mtime=stat.st_mtime),
+                        (title, body, docno, doctype, dbid)))
+
+    with write_transaction():
+        for old, entry, row in changes:
+            if old is not None:
+                db.execute_sql("DELETE FROM %s WHERE rowid = ?" % FULLTEXT_TABLE, (old.fulltext_row, ))
+                old.delete_instance()
+            if entry is None:
+                continue
+            cursor = db.execute_sql("INSERT INTO %s (title, body, docno, doctype, document) "
+                                    "VALUES (?, ?, ?, ?, ?)" % FULLTEXT_TABLE, row)
+            entry.fulltext_row = cursor.lastrowid
+            entry.save(force_insert=True)
+    return [path for path in paths if path not in documents]
+
+
+def search(query, limit=SEARCH_LIMIT):
+    """Search the full-text index.
+
+    Arguments:
+    query -- an FTS5 query (e.g. Bundesversammlung, or "Kleine Anfrage" AND Bahn)
+    limit -- maximum number of results
+
+    Returns a list of tuples (docno, doctype, dbid, snippet), best matches
+    first.
+    """
+    if not database.fulltext_available:
+        return []
+    cursor = db.execute_sql(
+        "SELECT docno, doctype, document, snippet(%s, 1, '[', ']', '...', ?) FROM %s "
+        "WHERE %s MATCH ? ORDER BY bm25(%s, ?, 1.0) LIMIT ?"
+        % (FULLTEXT_TABLE, FULLTEXT_TABLE, FULLTEXT_TABLE, FULLTEXT_TABLE),
+        (SNIPPET_WORDS, query, TITLE_WEIGHT, limit))
+    return cursor.fetchall()
@@ -0,0 +1,314 @@
+# -*- encoding: utf-8 -*-
+"""Manifest of downloaded files, to avoid re-validating unchanged files.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from models.database import FileManifest, write_transaction
+from multiprocessing.pool import ThreadPool
+import binascii
+import hashlib
+import os
+import threading
+
+
+# Number of threads validating and hashing files during a rebuild
+REBUILD_WORKERS = 4
+# Number of manifest entries written per transaction during a rebuild
+REBUILD_BATCH_SIZE = 500
+
+# In-memory copy of the manifest, loaded on first use, mapping the paths to
+# compact (size, mtime, valid, sha256, md5) tuples with binary digests, and
+# an index of the paths of the valid files by their binary SHA-256 digest
+# (a single path, or a tuple of paths for duplicates).  It has an entry for
+# every file of the mirror, so it only holds what the checks need; the full
+# entries are read from the database (see lookup).
+_entries = None
+_by_digest = {}
+_lock = threading.RLock()
+
+# Positions in the in-memory entries
+_SIZE, _MTIME, _VALID, _SHA256, _MD5 = range(5)
+
+
+def _load():
+    """Get the in-memory manifest, loading it from the database if needed."""
+    global _entries
+    with _lock:
+        if _entries is None:
+            _entries = {}
+            query = (FileManifest
+                     .select(FileManifest.path, FileManifest.size, FileManifest.mtime,
+                             FileManifest.valid, FileManifest.sha256, FileManifest.md5)
+                     .tuples())
+            for row in query.iterator():
+                # SQLite returns unicode, byte strings take a fourth of the memory
+                _add(row[0].encode("utf-8"), _compact(*row[1:]))
+        return _entries
+
+
+def _compact(size, mtime, valid, sha256, md5):
+    """Get the in-memory entry for the fields of a manifest entry."""
+    return (size, mtime, valid, _unhex(sha256), _unhex(md5))
+
+
+def _unhex(digest):
+    """Convert a hex digest (or None) to its binary form."""
+    return binascii.unhexlify(digest) if digest is not None else None
+
+
+def _hex(digest):
+    """Convert a binary digest (or None) to its hex form."""
+    return binascii.hexlify(digest) if digest is not None else None
+
+
+def _paths(digest):
+    """Get the paths of the valid files with a binary digest (lock held)."""
+    paths = _by_digest.get(digest, ())
+    return (paths, ) if isinstance(paths, basestring) else paths
+
+
+def _add(path, entry):
+    """Put an entry into the in-memory manifest (called with the lock held)."""
+    _remove(path)
+    _entries[path] = entry
+    digest = entry[_SHA256]
+    if entry[_VALID] and digest is not None:
+        paths = _paths(digest)
+        _by_digest[digest] = paths + (path, ) if paths else path
+
+
+def _remove(path):
+    """Remove an entry from the in-memory manifest (called with the lock held)."""
+    entry = _entries.pop(path, None)
+    if entry is None or entry[_SHA256] not in _by_digest:
+        return
+    digest = entry[_SHA256]
+    paths = tuple(other for other in _paths(digest) if other != path)
+    if len(paths) == 0:
+        del _by_digest[digest]
+    else:
+        _by_digest[digest] = paths if len(paths) > 1 else paths[0]
+
+
+def is_valid(path):
+    """Check if a file is a valid PDF, using the manifest where possible.
+
+    If the size and modification time of the file match the manifest, the
+    recorded result is returned without reading the file.  Otherwise, the
+    file is validated and hashed, and the manifest is updated.
+
+    Arguments:
+    path -- path to the file to check
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    entry = _load().get(path)
+    if entry is not None and entry[_SIZE] == stat.st_size and entry[_MTIME] == stat.st_mtime:
+        return entry[_VALID]
+    return update(path).valid
+
+
+def lookup(path):
+    """Get the manifest entry of a file, or None if it is unknown."""
+    return FileManifest.select().where(FileManifest.path == path).first()
+
+
+def original(path):
+    """Get the original of a file whose content also exists under other paths.
+
+    Of all files with the same content, the first one in sort order (i.e. the
+    lowest document number) is the original.
+
+    Arguments:
+    path -- path to the file
+
+    Returns the path of the original, or None if the file is the original or
+    has no duplicates.
+    """
+    entry = _load().get(path)
+    if entry is None or not entry[_VALID] or entry[_SHA256] is None:
+        return None
+    with _lock:
+        paths = sorted(_paths(entry[_SHA256]))
+    for other in paths:
+        if other == path:
+            return None
+        if os.path.isfile(other):
+            return other
+    return None
+
+
+def duplicates(root="documents"):
+    """Get all groups of files with the same content below a directory.
+
+    Returns a list of lists of paths, sorted so the original comes first.
+    """
+    _load()
+    with _lock:
+        groups = [sorted(path for path in paths if path.startswith(root))
+                  for paths in _by_digest.values() if not isinstance(paths, basestring)]
+    return [group for group in groups if len(group) > 1]
+
+
+def digests(path):
+    """Get the SHA-256 and MD5 hex digests of a file.
+
+    The digests are taken from the manifest, and the file is only read if it
+    has changed since it was recorded (or its MD5 was not recorded yet).
+
+    Arguments:
+    path -- path to the file
+
+    Returns a tuple (sha256, md5), which are None if the file is no valid PDF.
+    """
+    stat = os.stat(path)
+    entry = _load().get(path)
+    if (entry is None or entry[_SIZE] != stat.st_size or entry[_MTIME] != stat.st_mtime or
+            (entry[_VALID] and entry[_MD5] is None)):
+        entry = update(path)
+        return (entry.sha256, entry.md5)
+    return (_hex(entry[_SHA256]), _hex(entry[_MD5]))
+
+
+def update(path, sha256=None, valid=None, etag=None, last_modified=None, md5=None):
+    """Validate a file and record the result in the manifest.
+
+    Arguments:
+    path          -- path to the file
+    sha256        -- SHA-256 hex digest of the file, if already known (e.g.
+                     from download)
+    valid         -- whether the file is a valid PDF, if already known
+    etag          -- the ETag the server sent with the file, if known
+    last_modified -- the Last-Modified date the server sent, if known
+    md5           -- MD5 hex digest of the file, if already known
+
+    Returns the new FileManifest entry.
+    """
+    entry = scan(path, sha256, valid, md5)
+    old = lookup(path)
+    if etag is None and last_modified is None and old is not None and old.sha256 == entry.sha256:
+        # Same content as before, so the validators still apply
+        etag, last_modified = old.etag, old.last_modified
+    entry.etag = etag
+    entry.last_modified = last_modified
+    with write_transaction():
+        FileManifest.insert(**entry._data).upsert().execute()
+    with _lock:
+        _load()
+        _add(path, _compact(entry.size, entry.mtime, entry.valid, entry.sha256, entry.md5))
+    return entry
+
+
+def forget(path):
+    """Remove a file from the manifest (e.g. because it was deleted)."""
+    with write_transaction():
+        FileManifest.delete().where(FileManifest.path == path).execute()
+    with _lock:
+        _load()
+        _remove(path)
+
+
+def scan(path, sha256=None, valid=None, md5=None):
+    """Validate and hash a file, without touching the manifest.
+
+    Arguments:
+    path   -- path to the file
+    sha256 -- SHA-256 hex digest of the file, if already known
+    valid  -- whether the file is a valid PDF, if already known
+    md5    -- MD5 hex digest of the file, if already known
+
+    Returns an unsaved FileManifest entry.
+    """
+    # Imported here, as util.util uses this module
+    from .util import is_pdf
+    stat = os.stat(path)
+    if valid is None:
+        valid = is_pdf(path)
+    if (sha256 is None or md5 is None) and valid:
+        sha256, md5 = file_digests(path)
+    return FileManifest(path=path, size=stat.st_size, mtime=stat.st_mtime,
+                        valid=valid, sha256=sha256, md5=md5)
+
+
+def file_digests(path):
+    """Get the SHA-256 and MD5 hex digests of a file, reading it once."""
+    digests = (hashlib.sha256(), hashlib.md5())
+    with open(path, "rb") as fi:
+        for chunk in iter(lambda: fi.read(1024000), b""):
+            for digest in digests:
+                digest.update(chunk)
+    return tuple(digest.hexdigest() for digest in digests)
+
+
+def rebuild(root="documents", workers=REBUILD_WORKERS):
+    """Bring the manifest up to date with all PDFs below a directory.
+
+    Only files that are new or have changed since they were last recorded
+    are read, so this is cheap to run on an already-indexed tree.  Entries
+    for files that no longer exist are removed.
+
+    Arguments:
+    root    -- the directory to scan
+    workers -- number of threads validating and hashing files
+    """
+    entries = _load()
+    present = set()
+    changed = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.endswith(".pdf"):
+                continue
+            path = os.path.join(dirpath, filename)
+            present.add(path)
+            stat = os.stat(path)
+            entry = entries.get(path)
+            if entry is None or entry[_SIZE] != stat.st_size or entry[_MTIME] != stat.st_mtime:
+                changed.append(path)
+    print "INFO: Manifest needs updating for", len(changed), "of", len(present), "files"
+
+    # Validate and hash changed files in parallel, and write the results in
+    # batched transactions
+    pool = ThreadPool(processes=workers)
+    batch = []
+    for entry in pool.imap_unordered(scan, changed):
+        batch.append(entry)
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            _store(batch)
+            batch = []
+    _store(batch)
+    pool.close()
+    pool.join()
+
+    # Remove entries of files that have disappeared
+    removed = [path for path in entries if path.startswith(root) and path not in present]
+    for path in removed:
+        forget(path)
+    print "INFO: Manifest updated,", len(removed), "stale entries removed"
+
+
+def _store(batch):
+    """Write a batch of manifest entries in one transaction."""
+    if len(batch) == 0:
+        return
+    with write_transaction():
+        for entry in batch:
+            FileManifest.insert(**entry._data).upsert().execute()
+    with _lock:
+        for entry in batch:
+            _add(entry.path, _compact(entry.size, entry.mtime, entry.valid, entry.sha256, entry.md5))
@@ -0,0 +1,217 @@
+# -*- encoding: utf-8 -*-
+"""Queue-connected processing pipelines.
+
+Copyright (C) 2017  Max Maass
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from Queue import Queue
+import threading
+import traceback
+
+
+# Default maximum number of items waiting in front of a stage
+QUEUE_SIZE = 100
+# Default delay in seconds before retrying a failed item
+RETRY_DELAY = 10
+
+# Sentinel telling a worker thread to stop
+_STOP = object()
+
+
+class Stage(object):
+    """A processing stage with its own worker threads.
+
+    Every stage reads items from a bounded input queue, applies its function
+    to them and passes the results on to all downstream stages.  As the
+    queues are bounded, a slow stage will block the stages feeding it
+    (backpressure) instead of piling up work in memory.
+
+    Every input produces exactly one output (None if the function failed),
+    so ordered stages downstream can rely on seeing every sequence number.
+
+    Items failing with one of the retry_on exceptions are put into a retry
+    queue, and fed into the stage again after a delay, instead of blocking a
+    worker thread while waiting.  Their output is only passed on once they
+    succeed, or fail for the last time.  Items that failed for good are
+    counted, so the caller can tell them apart from items whose result was
+    None anyway.
+    """
+
+    def __init__(self, name, func, workers=1, maxsize=QUEUE_SIZE, ordered=False,
+                 retry_on=(), retries=0, backoff=None):
+        """Create a new stage.
+
+        Arguments:
+        name     -- name of the stage, for log messages and thread names
+        func     -- function to apply to every item
+        workers  -- number of worker threads
+        maxsize  -- maximum number of items waiting in the input queue
+        ordered  -- process items in the order they were fed into the
+                    pipeline (only possible with a single worker)
+        retry_on -- exception class (or tuple of classes) on which an item is
+                    retried
+        retries  -- maximum number of retries per item
+        backoff  -- function getting the delay in seconds before a retry from
+                    the number of the failed attempt (starting at 0)
+        """
+        if ordered and workers != 1:
+            raise ValueError("Ordered stages can only have one worker")
+        if ordered and retries > 0:
+            raise ValueError("Ordered stages can not retry items")
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.ordered = ordered
+        self.retry_on = retry_on
+        self.retries = retries
+        self.backoff = backoff or (lambda attempt: RETRY_DELAY)
+        self.queue = Queue(maxsize)
+        self.downstream = []
+        self._threads = []
+        # Number of items that failed for good
+        self.failures = 0
+        # Number of failed attempts of the items in the retry queue
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        """Put a (sequence number, value) tuple into the input queue."""
+        self.queue.put(item)
+
+    def start(self):
+        """Start the worker threads."""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="%s-%d" % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        """Wait until all queued items have been processed, then stop."""
+        # Items waiting for a retry count as unfinished, so this also waits
+        # for the retry queue to drain
+        self.queue.join()
+        for thread in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        """Worker thread main loop."""
+        # Out-of-order items waiting for their predecessors (ordered stages)
+        waiting = {}
+        next_seq = 0
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                self.queue.task_done()
+                break
+            if not self.ordered:
+                self._process(item)
+                continue
+            waiting[item[0]] = item
+            while next_seq in waiting:
+                self._process(waiting.pop(next_seq))
+                next_seq += 1
+            self.queue.task_done()
+
+    def _process(self, item):
+        """Apply the stage function to an item and pass on the result."""
+        seq, value = item
+        failed = False
+        try:
+            result = self.func(value)
+        except self.retry_on as e:
+            with self._lock:
+                attempt = self._attempts.get(seq, 0)
+                self._attempts[seq] = attempt + 1
+            if attempt < self.retries:
+                delay = self.backoff(attempt)
+                print "WARN: Stage", self.name, "failed on", value, "(%s) - retrying in %d seconds" % (e, delay)
+                timer = threading.Timer(delay, self._retry, [item])
+                timer.daemon = True
+                timer.start()
+                return
+            print "ERROR: Stage", self.name, "failed on", value, "(%s) - giving up" % e
+            result = None
+            failed = True
+        except Exception:
+            print "ERROR: Stage", self.name, "failed on", value
+            traceback.print_exc()
+            result = None
+            failed = True
+        with self._lock:
+            if failed:
+                self.failures += 1
+            self._attempts.pop(seq, None)
+        for stage in self.downstream:
+            stage.put((seq, result))
+        if not self.ordered:
+            self.queue.task_done()
+
+    def _retry(self, item):
+        """Feed a failed item into the stage again."""
+        # Put it back before marking the failed attempt as done, so the
+        # number of unfinished items never drops to zero in between
+        self.queue.put(item)
+        self.queue.task_done()
+
+
+class Pipeline(object):
+    """A tree of stages, fed with work items at the root."""
+
+    def __init__(self):
+        """Create an empty pipeline."""
+        self.stages = []
+        self._seq = 0
+
+    def add(self, stage, after=None):
+        """Add a stage to the pipeline.
+
+        Arguments:
+        stage -- the Stage to add
+        after -- the Stage whose results should be fed into the new stage, or
+                 None if this is the first stage
+
+        Returns the added stage.
+        """
+        if after is not None:
+            after.downstream.append(stage)
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        """Start all stages."""
+        for stage in self.stages:
+            stage.start()
+
+    def feed(self, value):
+        """Feed a work item into the first stage (blocks if it is full)."""
+        self.stages[0].put((self._seq, value))
+        self._seq += 1
+
+    def failures(self):
+        """Get the number of items that failed for good, in all stages."""
+        return sum(stage.failures for stage in self.stages)
+
+    def close(self):
+        """Wait for all fed items to pass through the pipeline."""
+        # Stages are always added after the stage feeding them, so closing
+        # them in order guarantees that every stage has received all its
+        # input before it is told to stop
+        for stage in self.stages:
+            stage.close()
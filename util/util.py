@@ -17,91 +17,453 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from collections import deque
+from email.utils import formatdate
+from Queue import Queue, Empty
+from requests.adapters import HTTPAdapter
+from urlparse import urlparse
+from . import manifest
 import requests
+import hashlib
 import os.path
-import subprocess
+import random
+import threading
 import time
 import magic
 
 
-def download(url, filename, session=None, retry=0):
+# Every PDF file starts with this signature
+PDF_SIGNATURE = b"%PDF-"
+# Suffix of files that are still being downloaded
+PARTIAL_SUFFIX = ".part"
+# Suffix of the files storing the validator of a partial download
+VALIDATOR_SUFFIX = ".validator"
+
+# Default size of the connection pool kept for each host
+HTTP_POOL_SIZE = 10
+
+# Number of attempts for a single request, and the base and maximum delay
+# in seconds of the exponential backoff between attempts
+REQUEST_ATTEMPTS = 4
+RETRY_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# Number of consecutive failed requests after which a host is considered
+# down, and seconds after which a single trial request is let through again
+BREAKER_THRESHOLD = 10
+BREAKER_COOLDOWN = 30.0
+
+# Hedged downloads: percentile of the recent response times of a host after
+# which a second request is sent to an alternate URL, maximum ratio of hedged
+# requests to all requests, and the number of response times kept (and
+# needed before hedging starts)
+HEDGE_PERCENTILE = 95
+HEDGE_RATIO = 0.05
+HEDGE_SAMPLES = 200
+HEDGE_MIN_SAMPLES = 20
+
+# Adaptive host limits: factor applied to the limit under stress, minimum
+# number of seconds between two cuts, weight of a new sample in the average
+# latency, the factor over the baseline latency at which the host is
+# considered to be under stress, and the number of recent requests over which
+# the lowest average latency is taken as the baseline
+AIMD_DECREASE = 0.5
+AIMD_COOLDOWN = 1.0
+AIMD_SMOOTHING = 0.2
+AIMD_LATENCY_FACTOR = 2.0
+AIMD_BASELINE_WINDOW = 200
+# The limit is only raised further while the throughput keeps up with this
+# fraction of the throughput before the last raise
+AIMD_THROUGHPUT_FLOOR = 0.9
+
+# Shared sessions, one per host, with their configured pool sizes
+_sessions = {}
+_pool_sizes = {}
+_sessions_lock = threading.Lock()
+
+# HostLimit objects limiting the requests to a host
+_host_limits = {}
+
+# CircuitBreaker objects of the hosts, created on first use
+_breakers = {}
+
+# Equivalent base URLs (e.g. mirrors) of the hosts, and their HedgePolicy
+# objects
+_mirrors = {}
+_hedge_policies = {}
+
+# libmagic handles, one per thread (they are expensive to create, but must
+# not be shared between threads)
+_magic = threading.local()
+
+
+class RequestFailed(Exception):
+    """A request failed repeatedly, or the download remained incomplete."""
+
+
+class NotPdf(RequestFailed):
+    """The server sent something else than a PDF."""
+
+
+def download(url, filename, session=None, retry=0, wait=True):
     """Download a file, if it exists.
 
     Arguments:
     url      -- the url to download
     filename -- the filename to which the file should be saved
-    session  -- a requests.Session-Object to use (to persist connections)
+    session  -- a requests.Session-Object to use, or None to use the shared
+                session of the host
     retry    -- Retry count
+    wait     -- retry failed attempts within this call, sleeping in between.
+                If False, only a single attempt is made, and every failure
+                raises RequestFailed (NotPdf for a response that is not a
+                PDF), so the caller can retry later without blocking the
+                thread.
+
+    Returns the filename, or None if the file does not exist (or the server
+    repeatedly sends something else than a PDF).  Raises RequestFailed if
+    the server could not be reached, so the caller can retry later (an
+    incomplete download is resumed then).
+
+    With the shared session, slow requests are hedged with a request to an
+    alternate URL, if the host has mirrors (see set_mirrors).
     """
+    hedge = session is None
+    if session is None:
+        session = get_session(url)
+    attempts = REQUEST_ATTEMPTS if wait else 1
+
     # Check if file already exists
     if os.path.isfile(filename):
-        # Check if file is indeed a PDF file
+        # Check if file is indeed a PDF file (using the manifest, so
+        # unchanged files that have been validated before are not read again)
         # File already exists, just return a reference to it.
         # (already processed files will be ignored by processing)
-        if is_pdf(filename):
+        if manifest.is_valid(filename):
             return filename
         # If this statement is reached, the file exists but isn't a .pdf
         # Delete the file and any converted plaintext version, if it exists
         os.remove(filename)
+        manifest.forget(filename)
         if os.path.isfile(filename[:-4] + ".txt"):
             os.remove(filename[:-4] + ".txt")
 
+    # Resume an interrupted download, if the server can tell us that the file
+    # has not changed in the meantime (via If-Range)
+    temp = filename + PARTIAL_SUFFIX
+    headers = {}
+    offset = 0
+    validator = _read_validator(temp)
+    if validator is not None:
+        offset = os.path.getsize(temp)
+        headers["Range"] = "bytes=%d-" % offset
+        headers["If-Range"] = validator
+
     # Start downloading the file in streaming mode, to save memory
-    # Do this in an endless loop to catch any connection errors and retry
-    while True:
-        try:
-            if session is None:
-                # No session passed, create new connection
-                req = requests.get(url, stream=True)
-            else:
-                # Reuse old session
-                req = session.get(url, stream=True)
-            break
-        except requests.exceptions.ConnectionError:
-            # We got a connection error. Sleep 1 second and try again.
-            time.sleep(1)
+    if hedge:
+        req = _hedged_get(url, headers, attempts)
+    else:
+        req = _request(session, "GET", url, stream=True, headers=headers, attempts=attempts)
 
     # Check if the file actually exists
     if req.status_code == 404:
+        req.close()
+        _discard_partial(temp)
         return None
 
-    # Open file descriptor for output file
-    with open(filename, "wb") as fo:
-        # Write to file in chunks
-        for chunk in req.iter_content(chunk_size=1024000):
-            fo.write(chunk)
-
-    # Check if we have actually downloaded a PDF file
-    if not is_pdf(filename):
-        if retry >= 3:
-            print "ERROR: Downloaded file", filename, "appears to not be a PDF. Using anyway."
+    # The partial download may already be complete (e.g. if we were
+    # interrupted right before renaming it), in which case there is nothing
+    # left to send
+    if req.status_code == 416:
+        req.close()
+        if _complete_partial(filename, req.headers, offset) is not None:
             return filename
-        time.sleep(1)
-        download(url, filename, session, retry + 1)
+        _discard_partial(temp)
+        return download(url, filename, None if hedge else session, retry + 1, wait)
+
+    # The server sends the whole file if it does not support ranges, or the
+    # file has changed since the partial download
+    if req.status_code != 206 or not req.headers.get("Content-Range", "").startswith("bytes %d-" % offset):
+        offset = 0
+
+    # Check the first bytes of the response before writing anything, so error
+    # pages are rejected without touching the disk (when resuming, the start
+    # of the file has already been checked)
+    chunks, first = _first_chunk(req)
+    if offset == 0 and not looks_like_pdf(req.headers.get("Content-Type", ""), first):
+        req.close()
+        if not wait:
+            raise NotPdf("Server did not send a PDF for %s" % filename)
+        if retry + 1 >= attempts:
+            print "ERROR: Server did not send a PDF for", filename, "- skipping"
+            return None
+        time.sleep(backoff_delay(retry))
+        return download(url, filename, None if hedge else session, retry + 1)
+
+    # Check that we got the whole file, otherwise try to resume
+    if _save_response(req, filename, chunks, first, offset) is None:
+        if retry + 1 >= attempts:
+            raise RequestFailed("Download of %s remained incomplete" % filename)
+        time.sleep(backoff_delay(retry))
+        return download(url, filename, None if hedge else session, retry + 1)
     return filename
 
 
-def _download_tuple(task_tuple):
-    """Helper function to download a file, with all params as tuple."""
-    return download(task_tuple[0], task_tuple[1])
+def _save_response(req, filename, chunks, first, offset=0, keep=None):
+    """Stream a response into a file.
 
+    The response is written to a temporary file, which is only renamed once
+    complete, so a half-written file can never pass for a finished download.
+    The file is hashed (SHA-256 and MD5) on the way, so neither the manifest
+    nor the uploader need to read it again.
+
+    Arguments:
+    req      -- the streaming response
+    filename -- the filename to which the file should be saved
+    chunks   -- the content iterator of the response
+    first    -- the first chunk, already taken from the iterator
+    offset   -- number of bytes already present in the partial download
+    keep     -- SHA-256 hex digest of the existing file: if the response has
+                the same content, the file is left untouched (it may be
+                hardlinked, see util.dedup), and only the manifest is updated
+
+    Returns the new manifest entry of the file, or None if the download was
+    incomplete (in which case the partial download is kept for resuming).
+    """
+    temp = filename + PARTIAL_SUFFIX
+    if offset == 0:
+        digests = (hashlib.sha256(), hashlib.md5())
+        _write_validator(temp, req.headers)
+    else:
+        digests = _partial_digests(temp)
+    expected = req.headers.get("Content-Length")
+    if expected is not None:
+        expected = offset + int(expected)
+    try:
+        with open(temp, "ab" if offset > 0 else "wb") as fo:
+            fo.write(first)
+            for digest in digests:
+                digest.update(first)
+            # Write to file in chunks
+            for chunk in chunks:
+                fo.write(chunk)
+                for digest in digests:
+                    digest.update(chunk)
+    except requests.exceptions.RequestException:
+        # Connection broke down while streaming, the .part file is kept so
+        # the next attempt can resume from there.  Without a Content-Length
+        # (chunked responses), the size can not tell us that the file is
+        # incomplete, so never accept it.
+        return None
+    finally:
+        req.close()
+
+    if expected is not None and os.path.getsize(temp) != expected:
+        return None
+
+    if keep is not None and digests[0].hexdigest() == keep:
+        _discard_partial(temp)
+        return _record(filename, req.headers, digests)
+    return _finish(filename, req.headers, digests)
+
+
+def _first_chunk(req):
+    """Start streaming the body of a response.
+
+    Returns a tuple (chunks, first) of the content iterator and the first
+    chunk taken from it.  Raises RequestFailed (after closing the response)
+    if the connection broke down.
+    """
+    chunks = req.iter_content(chunk_size=1024000)
+    try:
+        return (chunks, next(chunks, b""))
+    except requests.exceptions.RequestException as e:
+        req.close()
+        raise RequestFailed("Reading %s failed: %s" % (req.url, e))
+
+
+def _complete_partial(filename, headers, offset):
+    """Accept a partial download the server says is already complete.
+
+    This is the case if a resumed request is answered with 416 (Range Not
+    Satisfiable) and a Content-Range of bytes */<offset>.
+
+    Arguments:
+    filename -- the filename to which the file should be saved
+    headers  -- the headers of the 416 response
+    offset   -- the size of the partial download
+
+    Returns the new manifest entry of the file, or None if the partial
+    download is not complete (or not a PDF).
+    """
+    temp = filename + PARTIAL_SUFFIX
+    if headers.get("Content-Range", "") != "bytes */%d" % offset:
+        return None
+    with open(temp, "rb") as fi:
+        if fi.read(len(PDF_SIGNATURE)) != PDF_SIGNATURE:
+            return None
+    return _finish(filename, headers, _partial_digests(temp))
+
+
+def _finish(filename, headers, digests):
+    """Move a complete download into place and add it to the manifest.
+
+    Arguments:
+    filename -- the filename to which the file should be saved
+    headers  -- the headers of the response
+    digests  -- SHA-256 and MD5 objects fed with the contents of the file
 
-def get_html(url, session=None):
+    Returns the new manifest entry of the file.
+    """
+    temp = filename + PARTIAL_SUFFIX
+    os.rename(temp, filename)
+    _discard_partial(temp)
+    return _record(filename, headers, digests)
+
+
+def _record(filename, headers, digests):
+    """Record a downloaded file in the manifest.
+
+    Arguments:
+    filename -- the downloaded file
+    headers  -- the headers of the response
+    digests  -- SHA-256 and MD5 objects fed with the contents of the file
+
+    Returns the new manifest entry of the file.
+    """
+    return manifest.update(filename, sha256=digests[0].hexdigest(), valid=True,
+                           etag=headers.get("ETag"),
+                           last_modified=headers.get("Last-Modified"),
+                           md5=digests[1].hexdigest())
+
+
+def fetch_if_changed(url, filename, etag=None, last_modified=None, session=None):
+    """Re-download a file if it has changed on the server.
+
+    A conditional request is sent using the known validators, so unchanged
+    files only cost a single 304 response.  Without validators (e.g. for
+    files downloaded before they were recorded), the modification time of
+    the local copy is used instead, i.e. the time it was downloaded.
+    Servers that ignore the validators send the whole file, which is then
+    compared to the local copy by its digest.  The local copy is only
+    replaced if the content differs.
+
+    Arguments:
+    url           -- the url of the file
+    filename      -- the local copy of the file
+    etag          -- the ETag of the local copy, if known
+    last_modified -- the Last-Modified date of the local copy, if known
+    session       -- a requests.Session-Object to use, or None to use the
+                     shared session of the host
+
+    Returns a tuple (changed, entry), where entry is the manifest entry of
+    the file if a response was saved (None if unchanged or failed).
+    """
+    if session is None:
+        session = get_session(url)
+
+    headers = {}
+    if etag is not None:
+        headers["If-None-Match"] = etag
+    if last_modified is not None:
+        headers["If-Modified-Since"] = last_modified
+    elif etag is None and os.path.isfile(filename):
+        headers["If-Modified-Since"] = formatdate(os.path.getmtime(filename), usegmt=True)
+
+    try:
+        req = _request(session, "GET", url, stream=True, headers=headers)
+    except RequestFailed as e:
+        print "WARN: Refreshing", filename, "failed:", e
+        return (False, None)
+
+    if req.status_code == 304:
+        req.close()
+        return (False, None)
+    if req.status_code != 200:
+        print "WARN: Refreshing", filename, "failed with status code", req.status_code
+        req.close()
+        return (False, None)
+
+    try:
+        chunks, first = _first_chunk(req)
+    except RequestFailed as e:
+        print "WARN: Refreshing", filename, "failed:", e
+        return (False, None)
+    if not looks_like_pdf(req.headers.get("Content-Type", ""), first):
+        print "WARN: Server did not send a PDF when refreshing", filename
+        req.close()
+        return (False, None)
+
+    # Digest of the local copy (None if it is missing or no valid PDF)
+    keep = manifest.digests(filename)[0] if os.path.isfile(filename) else None
+    entry = _save_response(req, filename, chunks, first, keep=keep)
+    if entry is None:
+        print "WARN: Refreshing", filename, "was interrupted"
+        return (False, None)
+    return (keep != entry.sha256, entry)
+
+
+def _read_validator(temp):
+    """Get the validator (ETag or Last-Modified) of a partial download.
+
+    Returns None if there is no partial download that can be resumed.
+    """
+    if not (os.path.isfile(temp) and os.path.isfile(temp + VALIDATOR_SUFFIX)):
+        return None
+    if os.path.getsize(temp) == 0:
+        return None
+    with open(temp + VALIDATOR_SUFFIX) as fi:
+        return fi.read().strip() or None
+
+
+def _write_validator(temp, headers):
+    """Store the validator of a response next to the partial download.
+
+    Only strong ETags and Last-Modified dates can be used with If-Range.
+    """
+    validator = headers.get("ETag")
+    if validator is None or validator.startswith("W/"):
+        validator = headers.get("Last-Modified")
+    if validator is None:
+        _discard_partial(temp)
+        return
+    with open(temp + VALIDATOR_SUFFIX, "w") as fo:
+        fo.write(validator)
+
+
+def _discard_partial(temp):
+    """Remove the validator (and the file, if any) of a partial download."""
+    for path in (temp, temp + VALIDATOR_SUFFIX):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _partial_digests(temp):
+    """Get SHA-256 and MD5 objects fed with the contents of a partial download."""
+    digests = (hashlib.sha256(), hashlib.md5())
+    with open(temp, "rb") as fi:
+        for chunk in iter(lambda: fi.read(1024000), b""):
+            for digest in digests:
+                digest.update(chunk)
+    return digests
+
+
+def get_html(url, session=None, wait=True):
     """Get the HTML behind an URL.
 
     Arguments:
     url     -- the URL as a string
-    session -- a requests.Session-Object to use, or None if none should be used
+    session -- a requests.Session-Object to use, or None to use the shared
+               session of the host
+    wait    -- retry failed attempts, sleeping in between (if False, a single
+               attempt is made)
+
+    Returns the HTML, or None on client errors.  Raises RequestFailed if the
+    server could not be reached.
     """
-    while True:
-        try:
-            if session is None:
-                req = requests.get(url)
-            else:
-                req = session.get(url)
-            break
-        except requests.exceptions.ConnectionError:
-            time.sleep(1)
+    if session is None:
+        session = get_session(url)
+
+    req = _request(session, "GET", url, attempts=REQUEST_ATTEMPTS if wait else 1)
 
     if req.status_code != 200:
         print "ERROR: get_html failed, status code", req.status_code, "on URL", url
@@ -109,36 +471,447 @@ def get_html(url, session=None):
     return req.text
 
 
-def get_session():
-    """Get a Requests session."""
-    return requests.Session()
+def url_exists(url, session=None):
+    """Check if a file exists on the server, without downloading it.
 
+    Arguments:
+    url     -- the URL as a string
+    session -- a requests.Session-Object to use, or None to use the shared
+               session of the host
+
+    Returns True if the server answered the HEAD request with status 200.
+    Raises RequestFailed if the server could not be reached.
+    """
+    if session is None:
+        session = get_session(url)
 
-def pdf_to_text(files):
-    """Convert a number of PDFs to text files using pdftotext.
+    req = _request(session, "HEAD", url)
+
+    return req.status_code == 200
+
+
+def _request(session, method, url, attempts=REQUEST_ATTEMPTS, **kwargs):
+    """Send a request, within the limits of the host.
+
+    The outcome is reported to the limits and the circuit breaker of the
+    host, so adaptive limits can adjust to the load of the server, and all
+    workers pause while the host is down.  Connection errors, timeouts and
+    server errors are retried up to the given number of attempts, with
+    backoff.
+
+    A streaming response keeps its request slot on the host until it is
+    closed, as the body is only downloaded afterwards, so the caller must
+    always close it.
 
     Arguments:
-    files -- a List of files (as paths) to convert
+    session  -- the requests.Session-Object to use
+    method   -- the HTTP method (e.g. GET)
+    url      -- the URL as a string
+    attempts -- maximum number of attempts
+    kwargs   -- further arguments for requests.Session.request
+
+    Returns the response.  Raises RequestFailed if all attempts failed.
     """
-    # Ensure pdftotext is installed
-    devnull = open(os.devnull, "w")
-    try:
-        subprocess.Popen(["pdftotext"], stdout=devnull, stderr=devnull).communicate()
-    except OSError as e:
-        if e.errno == os.errno.ENOENT:
-            print "WARN: Please install pdftotext to enable automatic conversion to text files"
+    limit = _host_limits.get(host_of(url))
+    breaker = _breaker(url)
+    for attempt in range(attempts):
+        breaker.wait()
+        if limit is not None:
+            limit.acquire()
+        req = None
+        try:
+            start = time.time()
+            try:
+                req = session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException:
+                # Connection errors, timeouts, broken responses
+                pass
+            latency = time.time() - start
+            error = req is None or req.status_code >= 500
+            if limit is not None:
+                limit.record(latency, error, method)
+            breaker.record(error)
+            if not error:
+                if limit is not None and kwargs.get("stream"):
+                    _release_on_close(req, limit)
+                    limit = None
+                return req
+            if req is not None:
+                req.close()
+        finally:
+            if limit is not None:
+                limit.release()
+        if attempt + 1 < attempts:
+            time.sleep(backoff_delay(attempt))
+    raise RequestFailed("%s %s failed %d times" % (method, url, attempts))
+
+
+def _hedged_get(url, headers, attempts=REQUEST_ATTEMPTS):
+    """Send a streaming GET request, hedged with a request to a mirror.
+
+    If the response (headers) has not arrived after the usual response time
+    of the host (see HedgePolicy), the same request is sent to the first
+    alternate URL, and whichever response arrives first is used.  A request
+    in progress can not be aborted, so the losing response is closed as soon
+    as it arrives.
+
+    Arguments:
+    url      -- the URL as a string
+    headers  -- dict of request headers
+    attempts -- maximum number of attempts per request
+
+    Returns the response.  Raises RequestFailed if all requests failed.
+    """
+    urls = alternate_urls(url)
+    if len(urls) < 2:
+        return _request(get_session(url), "GET", url, stream=True, headers=headers,
+                        attempts=attempts)
+
+    policy = _hedge_policy(url)
+    results = Queue()
+
+    def fetch(target, primary):
+        start = time.time()
+        try:
+            req = _request(get_session(target), "GET", target, stream=True, headers=headers,
+                           attempts=attempts)
+        except RequestFailed as e:
+            results.put((None, e))
             return
+        if primary:
+            policy.record(time.time() - start)
+        results.put((req, None))
+
+    _start_thread(fetch, urls[0], True)
+    pending = 1
+    try:
+        result = results.get(timeout=policy.threshold())
+    except Empty:
+        result = None
+        if policy.allow():
+            _start_thread(fetch, urls[1], False)
+            pending += 1
+    # Take the first response, unless it failed and the other one is still
+    # on its way
+    if result is None:
+        result = results.get()
+    pending -= 1
+    while result[0] is None and pending > 0:
+        result = results.get()
+        pending -= 1
+    if pending > 0:
+        _start_thread(_close_responses, results, pending)
+    if result[0] is None:
+        raise result[1]
+    return result[0]
+
+
+def _close_responses(results, count):
+    """Close the responses of lost hedged requests as they arrive."""
+    for i in range(count):
+        req, error = results.get()
+        if req is not None:
+            req.close()
+
+
+def _start_thread(target, *args):
+    """Run a function in a new daemon thread."""
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+def set_mirrors(url, alternates):
+    """Set the equivalent base URLs for the host of an URL.
+
+    Arguments:
+    url        -- an URL on the host
+    alternates -- list of base URLs (e.g. https://mirror.example.org) serving
+                  the same paths, or an empty list
+    """
+    with _sessions_lock:
+        _mirrors[host_of(url)] = list(alternates)
+
+
+def alternate_urls(url):
+    """Get an URL followed by its equivalents on the mirrors of its host."""
+    parsed = urlparse(url)
+    path = parsed.path
+    if parsed.query:
+        path += "?" + parsed.query
+    return [url] + [base.rstrip("/") + path for base in _mirrors.get(parsed.netloc, [])]
+
+
+def _hedge_policy(url):
+    """Get the hedging policy for the host of an URL."""
+    host = host_of(url)
+    with _sessions_lock:
+        if host not in _hedge_policies:
+            _hedge_policies[host] = HedgePolicy()
+        return _hedge_policies[host]
+
+
+def hedge_stats(url):
+    """Get the number of requests and hedged requests to the host of an URL."""
+    policy = _hedge_policies.get(host_of(url))
+    if policy is None:
+        return (0, 0)
+    return (policy.requests, policy.hedges)
+
+
+def backoff_delay(attempt, base=RETRY_DELAY, cap=RETRY_MAX_DELAY):
+    """Get the delay before a retry (exponential backoff with full jitter).
+
+    The jitter keeps workers that failed at the same time from retrying in
+    lockstep.
+
+    Arguments:
+    attempt -- number of the failed attempt, starting at 0
+    base    -- delay in seconds after the first attempt (on average double)
+    cap     -- maximum delay in seconds
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_session(url=None, pool_size=None):
+    """Get a Requests session.
+
+    If an URL is given, the shared session for the host of that URL is
+    returned.  Every host (e.g. dipbt and pdok) gets its own session with its
+    own pool of keep-alive connections, which can be shared between threads.
+    Without an URL, a new, unshared session is created.
+
+    Arguments:
+    url       -- an URL on the host the session will be used for, or None
+    pool_size -- number of connections to keep open to the host, should match
+                 the number of workers using it (default: HTTP_POOL_SIZE)
+    """
+    if url is None:
+        return requests.Session()
+
+    host = host_of(url)
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = requests.Session()
+        session = _sessions[host]
+        # (Re)mount adapters if the pool size changed.  Keep a pool for
+        # both schemes, as mirrors may use https on the same host.
+        size = pool_size or _pool_sizes.get(host, HTTP_POOL_SIZE)
+        if _pool_sizes.get(host) != size:
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _pool_sizes[host] = size
+    return session
+
+
+def configure_session(url, pool_size):
+    """Set the connection pool size for the host of an URL.
+
+    Arguments:
+    url       -- an URL on the host to configure
+    pool_size -- number of connections to keep open to the host
+    """
+    get_session(url, pool_size)
+
+
+def set_host_limit(url, limit, rate=None, burst=1, min_limit=None, max_limit=None):
+    """Limit the requests to the host of an URL.
+
+    Arguments:
+    url       -- an URL on the host to limit
+    limit     -- maximum number of concurrent requests, or None for no limit
+    rate      -- maximum number of requests per second, or None for no limit
+    burst     -- number of requests that may be sent at once after an idle
+                 period, despite the rate limit
+    min_limit -- lower bound for an adaptive concurrency limit
+    max_limit -- upper bound for an adaptive concurrency limit, or None to
+                 keep the limit fixed
+    """
+    with _sessions_lock:
+        if limit is None and rate is None:
+            _host_limits.pop(host_of(url), None)
         else:
-            raise e
+            _host_limits[host_of(url)] = HostLimit(limit, rate, burst, min_limit, max_limit)
 
-    # pdftotext is installed - Process files
-    for file in files:
-        if file is None:
-            continue
-        if os.path.isfile(file[:-4] + ".txt"):
-            continue
-        subprocess.Popen(["pdftotext", "-layout", file], stdout=devnull, stderr=devnull).communicate()
-    pass
+
+def _breaker(url):
+    """Get the circuit breaker for the host of an URL."""
+    host = host_of(url)
+    with _sessions_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def host_limit(url):
+    """Get the current concurrency limit for the host of an URL (or None)."""
+    limit = _host_limits.get(host_of(url))
+    if limit is None:
+        return None
+    return limit.limit
+
+
+def _release_on_close(req, limit):
+    """Keep the request slot of a streaming response until it is closed.
+
+    Arguments:
+    req   -- the streaming response
+    limit -- the HostLimit the slot was taken from
+    """
+    close = req.close
+    released = []
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            if not released:
+                released.append(True)
+                limit.release()
+    req.close = close_and_release
+
+
+class HostLimit(object):
+    """Politeness limits for the requests to one host.
+
+    The number of concurrent requests is limited like with a semaphore.  The
+    request rate is limited with a token bucket: every request takes a token,
+    and tokens are refilled with the given rate, up to the burst size.
+
+    If bounds are given, the concurrency limit adapts to the server (AIMD):
+    after every window of as many successful requests as the limit, it is
+    raised by one, as long as this still increases the throughput.  On
+    connection errors, 5xx responses or rising latency, it is cut by
+    AIMD_DECREASE.  The latency is tracked per request method (quick HEAD
+    probes would otherwise make every download look slow), and compared to
+    the lowest average of the last AIMD_BASELINE_WINDOW requests, so the
+    baseline follows lasting changes instead of sticking to the best case.
+    """
+
+    def __init__(self, limit=None, rate=None, burst=1, min_limit=None, max_limit=None):
+        """Create a new limit.
+
+        Arguments:
+        limit     -- maximum number of concurrent requests, or None for no
+                     limit (the initial limit, if adaptive)
+        rate      -- maximum number of requests per second, or None for no
+                     limit
+        burst     -- maximum number of tokens in the bucket
+        min_limit -- lower bound of an adaptive limit
+        max_limit -- upper bound of an adaptive limit, or None for a fixed
+                     limit
+        """
+        self.limit = limit
+        self.rate = rate
+        self.burst = burst
+        self.min_limit = min_limit or 1
+        self.max_limit = max_limit
+        self.active = 0
+        self.tokens = burst
+        self.refilled = time.time()
+        # Statistics for adapting the limit: average latency and recent
+        # averages per request method
+        self.latency = {}
+        self.recent = {}
+        self.throughput = None
+        self.successes = 0
+        self.window_start = time.time()
+        self.last_cut = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait until a request may be sent."""
+        with self._cond:
+            while self.limit is not None and self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+        if self.rate is None:
+            return
+        while True:
+            with self._cond:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self):
+        """Mark a request as finished."""
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def record(self, latency, error, method="GET"):
+        """Adapt the limit to the outcome of a request.
+
+        Arguments:
+        latency -- seconds until the response arrived
+        error   -- whether the request failed (connection error or 5xx)
+        method  -- the HTTP method of the request
+        """
+        if self.max_limit is None or self.limit is None:
+            return
+        with self._cond:
+            stressed = error
+            if not error:
+                average = self.latency.get(method)
+                if average is None:
+                    average = latency
+                else:
+                    average += AIMD_SMOOTHING * (latency - average)
+                self.latency[method] = average
+                if method not in self.recent:
+                    self.recent[method] = deque(maxlen=AIMD_BASELINE_WINDOW)
+                self.recent[method].append(average)
+                stressed = average > AIMD_LATENCY_FACTOR * min(self.recent[method])
+            now = time.time()
+            if stressed:
+                # Multiplicative decrease, once per cooldown, as the requests
+                # in flight will report the same stress
+                if now - self.last_cut >= AIMD_COOLDOWN:
+                    self.limit = max(self.min_limit, int(self.limit * AIMD_DECREASE))
+                    self.last_cut = now
+                    self.successes = 0
+                    self.window_start = now
+                return
+
+            self.successes += 1
+            if self.successes < self.limit:
+                return
+            # A full window without stress: additive increase, unless the
+            # last increase did not bring more throughput
+            throughput = self.successes / max(now - self.window_start, 1e-6)
+            if self.throughput is None or throughput >= self.throughput * AIMD_THROUGHPUT_FLOOR:
+                if self.limit < self.max_limit:
+                    self.limit += 1
+                    self._cond.notify_all()
+            self.throughput = throughput
+            self.successes = 0
+            self.window_start = now
+
+
+def host_of(url):
+    """Get the host part of an URL (e.g. dipbt.bundestag.de)."""
+    return urlparse(url).netloc
+
+
+def looks_like_pdf(content_type, data):
+    """Check if the start of a response looks like a PDF file.
+
+    This is the same check libmagic performs, so files passing it will also
+    pass is_pdf.
+
+    Arguments:
+    content_type -- the Content-Type header of the response
+    data         -- the first bytes of the response body
+    """
+    if content_type.startswith("text/"):
+        return False
+    return data.startswith(PDF_SIGNATURE)
 
 
 def is_pdf(filepath):
@@ -150,5 +923,113 @@ def is_pdf(filepath):
     if filepath is None or not os.path.isfile(filepath):
         return False
 
-    mime = magic.Magic(mime=True)
-    return mime.from_file(filepath) == "application/pdf"
+    if not hasattr(_magic, "mime"):
+        _magic.mime = magic.Magic(mime=True)
+    return _magic.mime.from_file(filepath) == "application/pdf"
+
+
+class CircuitBreaker(object):
+    """Pauses all requests to a host while it is down.
+
+    After BREAKER_THRESHOLD consecutive failed requests, the breaker opens,
+    and all requests wait.  After the cooldown, a single trial request is let
+    through: if it succeeds, the breaker closes again, otherwise it stays
+    open for another cooldown.
+    """
+
+    def __init__(self, host, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        """Create a new, closed circuit breaker.
+
+        Arguments:
+        host      -- the host, for log messages
+        threshold -- number of consecutive failures opening the breaker
+        cooldown  -- seconds until a trial request is let through
+        """
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self._cond = threading.Condition()
+
+    def wait(self):
+        """Wait until a request may be sent to the host."""
+        with self._cond:
+            while self.opened is not None:
+                remaining = self.opened + self.cooldown - time.time()
+                if remaining <= 0 and not self.trial:
+                    self.trial = True
+                    return
+                # Wait for the cooldown, or for the result of the trial
+                self._cond.wait(remaining if remaining > 0 else None)
+
+    def record(self, error):
+        """Record the outcome of a request.
+
+        Arguments:
+        error -- whether the request failed (connection error or 5xx)
+        """
+        with self._cond:
+            if not error:
+                if self.opened is not None:
+                    print "INFO:", self.host, "is reachable again, resuming requests"
+                self.failures = 0
+                self.opened = None
+                self.trial = False
+                self._cond.notify_all()
+                return
+            self.failures += 1
+            if self.trial or (self.opened is None and self.failures >= self.threshold):
+                if self.opened is None:
+                    print "WARN:", self.host, "appears to be down, pausing requests"
+                self.opened = time.time()
+                self.trial = False
+                self._cond.notify_all()
+
+
+class HedgePolicy(object):
+    """Decides when to hedge the requests to a host.
+
+    A hedged request is sent when the response takes longer than the
+    HEDGE_PERCENTILE of the recent response times of the host.  The number
+    of hedged requests is capped at HEDGE_RATIO of all requests, so a slow
+    server does not get twice the load.
+    """
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, ratio=HEDGE_RATIO, samples=HEDGE_SAMPLES):
+        """Create a new policy without any response times.
+
+        Arguments:
+        percentile -- percentile of the response times to wait for
+        ratio      -- maximum ratio of hedged requests to all requests
+        samples    -- number of recent response times to keep
+        """
+        self.percentile = percentile
+        self.ratio = ratio
+        self.latencies = deque(maxlen=samples)
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def threshold(self):
+        """Get the seconds after which to hedge a new request (None: never)."""
+        with self._lock:
+            self.requests += 1
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * self.percentile // 100)]
+
+    def record(self, latency):
+        """Record the response time of a request."""
+        with self._lock:
+            self.latencies.append(latency)
+
+    def allow(self):
+        """Check if another hedged request may be sent, and count it."""
+        with self._lock:
+            if self.hedges >= self.ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True